@@ -0,0 +1,169 @@
+from app import db
+from models import User, Operation, ArchivedOperation, Wallet, Category, types
+from datetime import date, timedelta
+import numpy as np
+
+
+BUCKETS = ('day', 'week', 'month')
+PERCENTILES = (50, 90, 99)
+
+# Day number since 1970-01-01 of <table>.created, computed by the database
+# so rows come back as plain integers instead of datetime objects
+EPOCH_DAY = {
+    'sqlite': "CAST(julianday({table}.created) - 2440587.5 AS INTEGER)",
+    'postgresql': "CAST(floor(extract(epoch from {table}.created) / 86400) AS INTEGER)",
+    'mysql': "TO_DAYS({table}.created) - 719528",
+}
+
+
+def epoch_day(value):
+    return (value - date(1970, 1, 1)).days
+
+
+def load_columns(user_id, date_from, date_to, wallet_id=None):
+    # One query, returned as column arrays: day number, total in cents,
+    # type id, category id (-1 without one) and wallet id. Everything is
+    # an integer in the database (totals are stored in cents) so the rows
+    # go straight into numpy
+    def rows_of(model):
+        query = db.session.query(
+                db.literal_column(EPOCH_DAY[db.engine.dialect.name].format(table=model.__tablename__)),
+                model.total,
+                model.type_id,
+                db.func.coalesce(model.category_id, -1),
+                model.wallet_id,
+            ) \
+            .join(Wallet, model.wallet_id == Wallet.id) \
+            .filter(
+                Wallet.user_id == user_id,
+                model.created >= date_from,
+                model.created < date_to + timedelta(days=1),
+            )
+        if wallet_id:
+            query = query.filter(model.wallet_id == wallet_id)
+        return query
+
+    # The archive is read only when the range reaches back into it
+    statement = rows_of(Operation).statement
+    if User.query.get(user_id).needs_archive(date_from):
+        statement = db.union_all(statement, rows_of(ArchivedOperation).statement)
+
+    # Rows are read from the DB-API cursor, no per-row result processing
+    result = db.session.connection().execute(statement)
+    try:
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+
+    columns = np.array(rows, dtype=np.int64).reshape(-1, 5)
+    return tuple(columns[:, i] for i in range(5))
+
+
+def bucket_starts(days, bucket):
+    # First day (as a day number) of the bucket each day falls in
+    if bucket == 'day':
+        return days
+    if bucket == 'week':
+        # Day 0 was a Thursday, weeks start on Monday
+        return days - (days + 3) % 7
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    return months.astype('datetime64[D]').astype(np.int64)
+
+
+def bucket_labels(date_from, date_to, bucket):
+    days = np.arange(epoch_day(date_from), epoch_day(date_to) + 1, dtype=np.int64)
+    return np.unique(bucket_starts(days, bucket))
+
+
+def rolling_mean(values, window):
+    # Mean of the last `window` buckets, shorter at the start of the series
+    sums = np.cumsum(values, dtype=np.float64)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    return sums / counts
+
+
+def change(values):
+    # Relative change against the previous bucket, None where it was zero
+    result = [None]
+    for previous, current in zip(values[:-1], values[1:]):
+        result.append(round((current - previous) / previous, 4) if previous else None)
+    return result
+
+
+def label(day, bucket):
+    value = np.datetime64(int(day), 'D')
+    return str(value.astype('datetime64[M]')) if bucket == 'month' else str(value)
+
+
+def analytics(user_id, date_from, date_to, bucket='day', window=7, wallet_id=None):
+    # Chart data for the user's operations between date_from and date_to
+    # (inclusive). Series are columnar lists, one value per bucket, amounts
+    # in cents so the JSON stays small and exact
+    days, cents, type_ids, category_ids, wallet_ids = load_columns(user_id, date_from, date_to, wallet_id)
+
+    starts = bucket_labels(date_from, date_to, bucket)
+    index = np.searchsorted(starts, bucket_starts(days, bucket))
+    income = type_ids == types.id('income')
+    expense = type_ids == types.id('expense')
+
+    def series(mask):
+        return np.bincount(index[mask], weights=cents[mask], minlength=len(starts)).astype(np.int64)
+
+    income_series = series(income)
+    expense_series = series(expense)
+    counts = np.bincount(index, minlength=len(starts))
+
+    expenses = cents[expense]
+    percentiles = {
+        f'p{p}': int(value)
+        for p, value in zip(PERCENTILES, np.percentile(expenses, PERCENTILES) if len(expenses) else [0] * len(PERCENTILES))
+    }
+
+    # Per category and type totals: one bincount over a combined key
+    base = int(type_ids.max()) + 1 if len(type_ids) else 1
+    keys = category_ids * base + type_ids
+    unique, inverse = np.unique(keys, return_inverse=True)
+    category_totals = np.bincount(inverse, weights=cents).astype(np.int64)
+    category_counts = np.bincount(inverse)
+    names = dict(db.session.query(Category.id, Category.name).filter(Category.user_id == user_id))
+    categories = sorted((
+        {
+            'id': int(key // base) if key >= 0 else None,
+            'name': names.get(int(key // base)),
+            'type': types.name(int(key % base)),
+            'total': int(total),
+            'count': int(count),
+        }
+        for key, total, count in zip(unique, category_totals, category_counts)
+    ), key=lambda c: (c['type'] or '', -c['total']))
+
+    wallet_keys, wallet_inverse = np.unique(wallet_ids, return_inverse=True)
+    wallet_income = np.bincount(wallet_inverse[income], weights=cents[income], minlength=len(wallet_keys))
+    wallet_expense = np.bincount(wallet_inverse[expense], weights=cents[expense], minlength=len(wallet_keys))
+    wallets = [
+        {'id': int(id), 'income': int(income_total), 'expense': int(expense_total)}
+        for id, income_total, expense_total in zip(wallet_keys, wallet_income, wallet_expense)
+    ]
+
+    return {
+        'bucket': bucket,
+        'from': date_from.isoformat(),
+        'to': date_to.isoformat(),
+        'unit': 'cents',
+        'labels': [label(day, bucket) for day in starts],
+        'income': income_series.tolist(),
+        'expense': expense_series.tolist(),
+        'count': counts.tolist(),
+        'expense_rolling': np.rint(rolling_mean(expense_series, window)).astype(np.int64).tolist(),
+        'expense_change': change(expense_series.tolist()),
+        'window': window,
+        'totals': {
+            'income': int(income_series.sum()),
+            'expense': int(expense_series.sum()),
+            'count': int(len(cents)),
+        },
+        'expense_percentiles': percentiles,
+        'categories': categories,
+        'wallets': wallets,
+    }
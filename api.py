@@ -0,0 +1,519 @@
+from app import db, passwords
+from passwords import PasswordsBusy
+from money import Money
+from models import User, Wallet, Category, Operation, OperationBatch, IdempotencyKey, types
+from forms import WalletForm, CategoryForm
+from views import owned, encode_cursor, decode_cursor, conditional
+from flask import Blueprint, current_app, request, jsonify, Response
+from flask_login import current_user, login_user
+from werkzeug.datastructures import MultiDict
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, date, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+import hashlib
+import json
+
+
+API_PER_PAGE = 50
+API_MAX_PER_PAGE = 200
+ANALYTICS_MAX_DAYS = 5 * 366
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+
+def api_error(status, message, **extra):
+    response = jsonify(error=message, **extra)
+    response.status_code = status
+    return response
+
+
+def api_login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error(401, 'Authentication required')
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def json_payload():
+    # Floats are parsed as Decimal so totals keep their exact value
+    try:
+        payload = json.loads(request.get_data(as_text=True) or 'null', parse_float=Decimal)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def is_id(value):
+    # JSON integers only: bool is an int subclass, lists and objects can't be compared with ids
+    return type(value) is int
+
+
+def invalid_ids(payload, *names):
+    # Names of id fields that are present but not integers
+    return [name for name in names if payload.get(name) is not None and not is_id(payload[name])]
+
+
+def form_data(payload, *names):
+    # JSON object -> formdata so the existing WTForms validate API writes too
+    return MultiDict({name: str(payload[name]) for name in names if payload.get(name) is not None})
+
+
+# Idempotency-Key: the first request with a key is run and its response stored,
+# retries with the same key and body get the stored response back without
+# running the view again. Keys are per user and expire after IDEMPOTENCY_KEY_TTL,
+# a reservation that never got its response after IDEMPOTENCY_IN_PROGRESS_TIMEOUT
+def idempotent(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 100:
+            return api_error(400, 'Idempotency-Key is too long')
+
+        request_hash = hashlib.sha256(
+            request.method.encode() + b' ' + request.path.encode() + b'\n' + request.get_data()
+        ).hexdigest()
+        now = datetime.now()
+        expired = now - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+        abandoned = now - timedelta(seconds=current_app.config['IDEMPOTENCY_IN_PROGRESS_TIMEOUT'])
+
+        stored = IdempotencyKey.query.filter_by(user_id=current_user.id, key=key).first()
+        if stored is not None and (stored.created < expired or (stored.status_code is None and stored.created < abandoned)):
+            db.session.delete(stored)
+            db.session.commit()
+            stored = None
+
+        if stored is None:
+            # Reserving the key in its own transaction makes concurrent retries
+            # collide on the unique constraint instead of both running the view
+            stored = IdempotencyKey(user_id=current_user.id, key=key, request_hash=request_hash)
+            db.session.add(stored)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return api_error(409, 'A request with this Idempotency-Key is in progress')
+        elif stored.request_hash != request_hash:
+            return api_error(422, 'Idempotency-Key was already used for a different request')
+        elif stored.status_code is None:
+            return api_error(409, 'A request with this Idempotency-Key is in progress')
+        else:
+            response = Response(stored.response, status=stored.status_code, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        key_id = stored.id
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            db.session.rollback()
+            IdempotencyKey.query.filter_by(id=key_id).delete()
+            db.session.commit()
+            raise
+
+        # Server errors aren't stored, the client may retry them for real
+        if response.status_code >= 500:
+            IdempotencyKey.query.filter_by(id=key_id).delete()
+        else:
+            IdempotencyKey.query.filter_by(id=key_id).update({
+                'status_code': response.status_code,
+                'response': response.get_data(as_text=True),
+            })
+        db.session.commit()
+        return response
+
+    return wrapper
+
+
+# Serialization, amounts are sent as strings to keep their precision
+def money(value):
+    return str(Money.of(value)) if value is not None else None
+
+
+def wallet_json(wallet):
+    return {
+        'id': wallet.id,
+        'name': wallet.name,
+        'pay_type': wallet.pay_type,
+        'balance': money(wallet.balance),
+        'version': wallet.version,
+    }
+
+
+def category_json(category):
+    return {
+        'id': category.id,
+        'name': category.name,
+        'type': types.name(category.type_id),
+    }
+
+
+def operation_json(operation):
+    return {
+        'id': operation.id,
+        'created': operation.created.isoformat(),
+        'wallet_id': operation.wallet_id,
+        'category_id': operation.category_id,
+        'type': types.name(operation.type_id),
+        'total': money(operation.total),
+        'description': operation.description,
+    }
+
+
+def parse_type(value):
+    # "income" / "expense" or a type id
+    if isinstance(value, str):
+        return types.id(value)
+    if is_id(value) and types.name(value) is not None:
+        return value
+    return None
+
+
+def parse_operation(item, wallet_ids, category_types):
+    # Validates one operation against the user's wallets and categories that
+    # were loaded once for the whole request. Returns (values, errors)
+    if not isinstance(item, dict):
+        return None, {'operation': 'Must be an object'}
+
+    errors = {}
+    wallet_id = item.get('wallet_id')
+    if not is_id(wallet_id) or wallet_id not in wallet_ids:
+        errors['wallet_id'] = 'Unknown wallet'
+
+    type_id = parse_type(item.get('type'))
+    if type_id is None:
+        errors['type'] = 'Must be one of: ' + ', '.join(name for _, name in types.choices())
+
+    category_id = item.get('category_id')
+    if category_id is not None:
+        if not is_id(category_id) or category_id not in category_types:
+            errors['category_id'] = 'Unknown category'
+        elif type_id is not None and category_types[category_id] != type_id:
+            errors['category_id'] = 'Category is of a different type'
+
+    try:
+        total = Decimal(str(item.get('total')))
+        if not total.is_finite() or total <= 0 or total > Money.MAX:
+            raise InvalidOperation
+    except InvalidOperation:
+        errors['total'] = 'Must be a positive number'
+
+    created = item.get('created')
+    if created is not None:
+        try:
+            created = datetime.fromisoformat(created)
+        except (TypeError, ValueError):
+            errors['created'] = 'Must be an ISO 8601 date and time'
+
+    description = item.get('description')
+    if description is not None and (not isinstance(description, str) or len(description) > 150):
+        errors['description'] = 'Must be a string of at most 150 characters'
+
+    if errors:
+        return None, errors
+
+    return {
+        'wallet_id': wallet_id,
+        'type_id': type_id,
+        'category_id': category_id,
+        'total': Money.of(total),
+        'description': description,
+        'created': created,
+    }, None
+
+
+def user_wallets_and_categories(user, requested=()):
+    # Which of the requested wallets the user owns, checked in the database.
+    # The wallet ids cached with the session identity can be a minute old in
+    # another worker, and a deleted wallet's id may belong to someone else by now
+    requested = {id for id in requested if is_id(id)}
+    wallet_ids = set()
+    if requested:
+        wallet_ids = {
+            id for id, in db.session.query(Wallet.id).filter(Wallet.id.in_(requested), Wallet.user_id == user.id)
+        }
+    category_types = dict(db.session.query(Category.id, Category.type_id).filter(Category.user_id == user.id))
+    return wallet_ids, category_types
+
+
+# Routes
+@bp.route('/login', methods=['POST'])
+def api_login():
+    payload = json_payload() or {}
+    if not isinstance(payload.get('username', ''), str):
+        return api_error(400, 'Username must be a string')
+    user = User.query.filter_by(username=payload.get('username')).first()
+    try:
+        valid = isinstance(payload.get('password'), str) and passwords.verify(user, payload['password'])
+    except PasswordsBusy as e:
+        response = api_error(503, str(e))
+        response.headers['Retry-After'] = '1'
+        return response
+    if valid:
+        # verify may have rehashed the password to the current policy
+        db.session.commit()
+        login_user(user)
+        return jsonify(id=user.id, username=user.username)
+    return api_error(401, 'Username or Password is not correct')
+
+
+@bp.route('/wallets')
+@api_login_required
+def api_wallets():
+    return jsonify(wallets=[wallet_json(w) for w in current_user.get_wallets()])
+
+
+@bp.route('/wallets', methods=['POST'])
+@api_login_required
+@idempotent
+def api_create_wallet():
+    payload = json_payload()
+    if payload is None:
+        return api_error(400, 'Expected a JSON object')
+
+    form = WalletForm(form_data(payload, 'name', 'pay_type', 'balance'))
+    if not form.validate():
+        return api_error(422, 'Invalid wallet', errors=form.errors)
+
+    wallet = Wallet(
+        name=form.name.data,
+        pay_type=form.pay_type.data,
+        balance=form.balance.data,
+        user_id=current_user.id
+    )
+    db.session.add(wallet)
+    current_user.touch()
+    db.session.commit()
+
+    response = jsonify(wallet_json(wallet))
+    response.status_code = 201
+    return response
+
+
+@bp.route('/categories')
+@api_login_required
+def api_categories():
+    return jsonify(categories=[category_json(c) for c in current_user.get_all_categories()])
+
+
+@bp.route('/categories', methods=['POST'])
+@api_login_required
+@idempotent
+def api_create_category():
+    payload = json_payload()
+    if payload is None:
+        return api_error(400, 'Expected a JSON object')
+
+    form = CategoryForm(form_data(payload, 'name'))
+    form.type_id.choices = types.choices()
+    form.type_id.data = parse_type(payload.get('type'))
+    if not form.validate() or form.type_id.data is None:
+        errors = dict(form.errors)
+        if form.type_id.data is None:
+            errors['type'] = ['Must be one of: ' + ', '.join(name for _, name in types.choices())]
+        errors.pop('type_id', None)
+        return api_error(422, 'Invalid category', errors=errors)
+
+    category = Category(name=form.name.data, type_id=form.type_id.data, user_id=current_user.id)
+    db.session.add(category)
+    current_user.touch()
+    db.session.commit()
+
+    response = jsonify(category_json(category))
+    response.status_code = 201
+    return response
+
+
+@bp.route('/operations')
+@api_login_required
+def api_operations():
+    try:
+        per_page = min(int(request.args.get('per_page', API_PER_PAGE)), API_MAX_PER_PAGE)
+        filters = {
+            'wallet_id': request.args.get('wallet_id', type=int),
+            'category_id': request.args.get('category_id', type=int),
+            'type_id': parse_type(request.args['type']) if 'type' in request.args else None,
+        }
+    except ValueError:
+        return api_error(400, 'Invalid query parameters')
+
+    cursor = request.args.get('cursor')
+    page = current_user.get_operations_page(
+        cursor=decode_cursor(cursor) if cursor else None,
+        per_page=max(per_page, 1),
+        **filters
+    )
+    return jsonify(
+        operations=[operation_json(op) for op in page.operations],
+        next_cursor=encode_cursor(page.next_cursor) if page.next_cursor else None,
+    )
+
+
+@bp.route('/operations', methods=['POST'])
+@api_login_required
+@idempotent
+def api_create_operation():
+    payload = json_payload()
+    if payload is None:
+        return api_error(400, 'Expected a JSON object')
+    fields = invalid_ids(payload, 'wallet_id', 'category_id')
+    if fields:
+        return api_error(400, 'Ids must be integers', fields=fields)
+
+    values, errors = parse_operation(payload, *user_wallets_and_categories(current_user, [payload.get('wallet_id')]))
+    if errors:
+        return api_error(422, 'Invalid operation', errors=errors)
+
+    operation = Operation(
+        total=values['total'],
+        type_id=values['type_id'],
+        wallet_id=values['wallet_id'],
+        category_id=values['category_id'],
+    )
+    operation.description = values['description']
+    if values['created']:
+        operation.created = values['created']
+
+    db.session.add(operation)
+    current_user.touch()
+    db.session.commit()
+
+    response = jsonify(operation_json(operation))
+    response.status_code = 201
+    return response
+
+
+@bp.route('/operations/batch', methods=['POST'])
+@api_login_required
+@idempotent
+def api_create_operations():
+    # All operations are validated first, nothing is written if any is invalid.
+    # Then one executemany insert, one balance update per wallet and one
+    # rollup update per month bucket, all in a single transaction
+    payload = json_payload()
+    items = payload.get('operations') if payload else None
+    if not isinstance(items, list) or not items:
+        return api_error(400, 'Expected {"operations": [...]}')
+    limit = current_app.config['API_BATCH_LIMIT']
+    if len(items) > limit:
+        return api_error(413, f'At most {limit} operations per batch')
+    malformed = []
+    for index, item in enumerate(items):
+        fields = invalid_ids(item, 'wallet_id', 'category_id') if isinstance(item, dict) else []
+        if fields:
+            malformed.append({'index': index, 'fields': fields})
+    if malformed:
+        return api_error(400, 'Ids must be integers', operations=malformed)
+
+    requested = [item.get('wallet_id') for item in items if isinstance(item, dict)]
+    wallet_ids, category_types = user_wallets_and_categories(current_user, requested)
+    rows = []
+    invalid = []
+    for index, item in enumerate(items):
+        values, errors = parse_operation(item, wallet_ids, category_types)
+        if errors:
+            invalid.append({'index': index, 'errors': errors})
+        else:
+            rows.append(values)
+    if invalid:
+        return api_error(422, 'Invalid operations', operations=invalid)
+
+    batch = OperationBatch(user_id=current_user.id, chunk_size=limit)
+    for values in rows:
+        batch.add(**values)
+    count = batch.commit()
+
+    response = jsonify(created=count)
+    response.status_code = 201
+    return response
+
+
+@bp.route('/transfers', methods=['POST'])
+@api_login_required
+@idempotent
+def api_create_transfer():
+    payload = json_payload()
+    if payload is None:
+        return api_error(400, 'Expected a JSON object')
+    fields = invalid_ids(payload, 'from_wallet_id', 'to_wallet_id')
+    if fields:
+        return api_error(400, 'Ids must be integers', fields=fields)
+
+    source = owned(Wallet, payload.get('from_wallet_id'))
+    target = owned(Wallet, payload.get('to_wallet_id'))
+    errors = {}
+    if source is None:
+        errors['from_wallet_id'] = 'Unknown wallet'
+    if target is None:
+        errors['to_wallet_id'] = 'Unknown wallet'
+    elif source is not None and source.id == target.id:
+        errors['to_wallet_id'] = 'Must be a different wallet'
+    try:
+        total = Decimal(str(payload.get('total')))
+        if not total.is_finite() or total <= 0 or total > Money.MAX:
+            raise InvalidOperation
+    except InvalidOperation:
+        errors['total'] = 'Must be a positive number'
+    if errors:
+        return api_error(422, 'Invalid transfer', errors=errors)
+
+    expense_id, income_id = types.id('expense'), types.id('income')
+    out_transfer = Operation(
+        total=total,
+        type_id=expense_id,
+        wallet_id=source.id,
+        category_id=types.transfer_category(current_user.id, expense_id),
+        change_balance=False
+    )
+    in_transfer = Operation(
+        total=total,
+        type_id=income_id,
+        wallet_id=target.id,
+        category_id=types.transfer_category(current_user.id, income_id),
+        change_balance=False
+    )
+
+    db.session.add_all([out_transfer, in_transfer])
+    Wallet.apply_deltas({
+        out_transfer.wallet_id: out_transfer.balance_delta,
+        in_transfer.wallet_id: in_transfer.balance_delta,
+    }, reason='transfer')
+    current_user.touch()
+    db.session.commit()
+
+    response = jsonify(operations=[operation_json(out_transfer), operation_json(in_transfer)])
+    response.status_code = 201
+    return response
+
+
+@bp.route('/analytics')
+@api_login_required
+@conditional
+def api_analytics():
+    # ?from=YYYY-MM-DD&to=YYYY-MM-DD&bucket=day|week|month&window=7&wallet_id=
+    # numpy is imported on the first request, not when a worker boots
+    import analytics
+
+    try:
+        date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if 'to' in request.args else date.today()
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date() \
+            if 'from' in request.args else date_to - timedelta(days=364)
+        window = int(request.args.get('window', 7))
+        wallet_id = request.args.get('wallet_id', type=int)
+    except ValueError:
+        return api_error(400, 'Invalid query parameters')
+
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in analytics.BUCKETS:
+        return api_error(400, 'bucket must be one of: ' + ', '.join(analytics.BUCKETS))
+    if date_from > date_to or (date_to - date_from).days > ANALYTICS_MAX_DAYS:
+        return api_error(400, f'from must be before to and at most {ANALYTICS_MAX_DAYS} days apart')
+    if not 1 <= window <= 366:
+        return api_error(400, 'window must be between 1 and 366')
+
+    return jsonify(analytics.analytics(current_user.id, date_from, date_to, bucket, window, wallet_id))
@@ -1,16 +1,57 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask_login import LoginManager
+from profiler import SqlProfiler
+from uploads import UploadStore
+from cache import Cache
+from database import RoutingSQLAlchemy
+from passwords import PasswordHasher
 
 
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
+# Extensions are created unbound and attached to the app in create_app,
+# so importing a module never builds or configures an application
+db = RoutingSQLAlchemy()
+login_manager = LoginManager()
+profiler = SqlProfiler()
+uploads = UploadStore()
+cache = Cache()
+passwords = PasswordHasher()
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
 
-from views import *
+def create_app(config=None, cli=True):
+    # config: mapping applied over config.py. cli=False leaves out the
+    # commands and Flask-Migrate (which imports Alembic), web workers don't need them
+    app = Flask(__name__)
+    app.config.from_pyfile('config.py')
+    if config:
+        app.config.from_mapping(config)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = 'auth.login'
+    profiler.init_app(app)
+    uploads.init_app(app)
+    cache.init_app(app)
+    passwords.init_app(app)
+
+    from models import types
+    from views import auth, wallets, operations, categories
+    import api
+
+    app.before_first_request(types.warm)
+    app.add_template_global(types.name, 'type_name')
+    for blueprint in (auth.bp, wallets.bp, operations.bp, categories.bp, api.bp):
+        app.register_blueprint(blueprint)
+
+    if cli:
+        from flask_migrate import Migrate
+        import commands
+
+        Migrate(app, db)
+        for command in commands.COMMANDS:
+            app.cli.add_command(command)
+
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
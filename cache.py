@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import pickle
+import threading
+import time
+
+
+class LRUCache:
+    # In-process cache with a size bound and per-entry TTL. Each worker
+    # process has its own copy and never sees another worker's writes or
+    # deletes, so under gunicorn it is only correct for keys that carry a
+    # version read from the database (dashboard:<user>:<data_version>) or
+    # for entries allowed to be stale for their TTL. Use RedisCache when
+    # a delete has to reach every worker
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (ttl or self.ttl)
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache:
+    # Same interface on top of a Redis-compatible server, shared by all workers
+
+    def __init__(self, url, ttl=300, prefix='wallet:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_cache(config):
+    # CACHE_URL: 'memory' (default) or redis://host:port/db
+    url = config.get('CACHE_URL') or 'memory'
+    ttl = config.get('CACHE_TTL', 300)
+    if url == 'memory':
+        return LRUCache(maxsize=config.get('CACHE_MAXSIZE', 1024), ttl=ttl)
+    return RedisCache(url, ttl=ttl)
+
+
+class Cache:
+    # Extension holder, the backend is picked from the app config in init_app
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_cache(app.config)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
@@ -0,0 +1,170 @@
+from app import db, uploads
+from models import OperationSummary, User, Wallet, Operation, ArchivedOperation, LedgerEntry, BalanceSnapshot, RecurringOperation, IdempotencyKey
+from importer import import_statement, StatementError
+from uploads import IMAGE_EXTENSIONS
+import search
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+import click
+import os
+import time
+
+
+@click.command('rebuild-summaries')
+@with_appcontext
+@click.option('--user-id', type=int, default=None, help='Rebuild only this user\'s rollup.')
+@click.option('--check', is_flag=True, help='Report out of date rows without rewriting them.')
+def rebuild_summaries(user_id, check):
+    """Backfill or reconcile the monthly operation_summaries rollup."""
+    mismatched = OperationSummary.rebuild(user_id=user_id, dry_run=check)
+    for user, wallet, category, op_type, month in mismatched:
+        click.echo(f'user {user} wallet {wallet} category {category} type {op_type} month {month:%Y-%m}')
+
+    if check:
+        click.echo(f'{len(mismatched)} summary rows out of date')
+    else:
+        click.echo(f'Rebuilt summaries, {len(mismatched)} rows corrected')
+
+
+@click.command('import-statement')
+@with_appcontext
+@click.argument('username')
+@click.argument('wallet_id', type=int)
+@click.argument('statement', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'statement_format', type=click.Choice(['csv', 'ofx']), default='csv')
+@click.option('--chunk-size', type=int, default=1000, help='Rows per executemany batch.')
+def import_statement_command(username, wallet_id, statement, statement_format, chunk_size):
+    """Import a bank statement file into one of the user's wallets."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user {username}')
+    wallet = Wallet.query.filter_by(id=wallet_id, user_id=user.id).first()
+    if wallet is None:
+        raise click.ClickException(f'User {username} has no wallet {wallet_id}')
+
+    try:
+        count = import_statement(user.id, wallet.id, statement, statement_format, chunk_size=chunk_size)
+    except StatementError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f'{count} operations imported')
+
+
+@click.command('search-reindex')
+@with_appcontext
+def search_reindex():
+    """Rebuild the operations full-text index."""
+    search.reindex()
+    click.echo('Search index rebuilt')
+
+
+@click.command('generate-thumbnails')
+@with_appcontext
+def generate_thumbnails():
+    """Create missing thumbnails for uploaded receipt images."""
+    names = {name for name, in Operation.query.with_entities(Operation.filename).filter(Operation.filename.isnot(None))}
+    futures = [
+        uploads.submit(name) for name in sorted(names)
+        if name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS
+        and os.path.exists(uploads.path(name)) and not os.path.exists(uploads.path(name, thumbnail=True))
+    ]
+    created = sum(1 for future in futures if future.result())
+    click.echo(f'{created} thumbnails created')
+
+
+@click.command('snapshot-balances')
+@with_appcontext
+def snapshot_balances():
+    """Snapshot wallet balances from the ledger, run it periodically."""
+    taken_at = datetime.now() - timedelta(seconds=current_app.config['LEDGER_SNAPSHOT_LAG'])
+    count = BalanceSnapshot.take(taken_at)
+    click.echo(f'{count} wallet balances snapshotted at {taken_at:%Y-%m-%d %H:%M:%S}')
+
+
+@click.command('purge-idempotency-keys')
+@with_appcontext
+def purge_idempotency_keys():
+    """Delete expired Idempotency-Key responses, run it periodically."""
+    before = datetime.now() - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+    count = IdempotencyKey.purge(before)
+    click.echo(f'{count} idempotency keys created before {before:%Y-%m-%d %H:%M:%S} deleted')
+
+
+@click.command('reconcile-balances')
+@with_appcontext
+@click.option('--wallet-id', type=int, default=None, help='Check only this wallet.')
+def reconcile_balances(wallet_id):
+    """Verify wallets.balance against the ledger."""
+    mismatched = LedgerEntry.reconcile(wallet_id=wallet_id)
+    for id, balance, expected in mismatched:
+        click.echo(f'wallet {id} balance {balance} ledger {expected}')
+
+    click.echo(f'{len(mismatched)} wallet balances differ from the ledger')
+    if mismatched:
+        raise SystemExit(1)
+
+
+def recurring_tick():
+    started = time.perf_counter()
+    count = RecurringOperation.run_due(
+        batch_size=current_app.config['RECURRING_BATCH_SIZE'],
+        max_catch_up=current_app.config['RECURRING_MAX_CATCH_UP'],
+    )
+    click.echo(f'{count} recurring operations created in {time.perf_counter() - started:.2f}s')
+
+
+@click.command('recurring-tick')
+@with_appcontext
+def recurring_tick_command():
+    """Create all due recurring operations, run it from cron."""
+    recurring_tick()
+
+
+@click.command('recurring-scheduler')
+@with_appcontext
+@click.option('--interval', type=int, default=60, help='Seconds between ticks.')
+def recurring_scheduler(interval):
+    """Run recurring-tick in a loop as a long-lived process."""
+    while True:
+        try:
+            recurring_tick()
+        except Exception as e:
+            # Whatever failed is still due and is retried on the next tick
+            db.session.rollback()
+            click.echo(f'Tick failed: {e}', err=True)
+        finally:
+            db.session.remove()
+        time.sleep(interval)
+
+
+@click.command('archive-operations')
+@with_appcontext
+@click.option('--days', type=int, default=None, help='Archive operations older than this, ARCHIVE_AFTER_DAYS by default.')
+@click.option('--batch-size', type=int, default=None, help='Operations per transaction, ARCHIVE_BATCH_SIZE by default.')
+@click.option('--max-batches', type=int, default=None, help='Stop after this many batches, the next run carries on.')
+def archive_operations(days, batch_size, max_batches):
+    """Move old operations to operations_archive in resumable batches."""
+    days = days if days is not None else current_app.config['ARCHIVE_AFTER_DAYS']
+    before = datetime.now() - timedelta(days=days)
+    started = time.perf_counter()
+    moved = ArchivedOperation.archive(
+        before,
+        batch_size=batch_size or current_app.config['ARCHIVE_BATCH_SIZE'],
+        max_batches=max_batches,
+    )
+    click.echo(f'Archived {moved} operations created before {before:%Y-%m-%d} in {time.perf_counter() - started:.1f}s')
+
+
+COMMANDS = [
+    rebuild_summaries,
+    import_statement_command,
+    search_reindex,
+    generate_thumbnails,
+    snapshot_balances,
+    purge_idempotency_keys,
+    reconcile_balances,
+    recurring_tick_command,
+    recurring_scheduler,
+    archive_operations,
+]
@@ -5,5 +5,66 @@ from os.path import join, dirname, realpath
 SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
 SQLALCHEMY_ECHO = False
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Connection pool for server databases, SQLite ignores these
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+DATABASE_POOL_RECYCLE = 1800
+DATABASE_POOL_PRE_PING = True
+# Optional read replica for read-only pages. A client reads from the primary
+# for REPLICA_READ_YOUR_WRITES seconds after each write it makes
+SQLALCHEMY_REPLICA_URI = os.environ.get('SQLALCHEMY_REPLICA_URI')
+REPLICA_READ_YOUR_WRITES = 5
 SECRET_KEY = 'very secret csrf token'
-UPLOAD_FOLDER = join(dirname(realpath(__file__)), 'static/uploads')
\ No newline at end of file
+UPLOAD_FOLDER = join(dirname(realpath(__file__)), 'static/uploads')
+
+# Receipts: per-file limit, streaming chunk size, thumbnail box and worker threads
+UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (100, 100)
+THUMBNAIL_WORKERS = 2
+# Whole request body, Werkzeug answers 413 before the view runs
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+
+# Per-request SQL profiling: X-SQL-* headers, log lines and /metrics
+SQL_PROFILING = os.environ.get('SQL_PROFILING') == '1'
+SQL_SLOW_QUERY_MS = 100
+SQL_N_PLUS_ONE_THRESHOLD = 5
+
+# Dashboard cache: 'memory' for a per-process LRU or a redis:// URL. Dashboard
+# entries are keyed on the user's data_version, so 'memory' stays correct with
+# several workers, only less effective
+CACHE_URL = os.environ.get('CACHE_URL', 'memory')
+CACHE_TTL = 300
+CACHE_MAXSIZE = 1024
+# Session identity (the logged in user and their wallet ids) kept in the same
+# cache. With 'memory' each worker holds its own copy for up to this long
+IDENTITY_CACHE_TTL = 60
+
+# JSON API: operations per batch request, lifetime of stored Idempotency-Key responses
+API_BATCH_LIMIT = 500
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+# A reservation with no response after this many seconds belongs to a worker
+# that died mid-request, the next retry runs the request again
+IDEMPOTENCY_IN_PROGRESS_TIMEOUT = 60
+
+# Balance snapshots cover ledger entries older than this many seconds
+LEDGER_SNAPSHOT_LAG = 300
+
+# Recurring operations: definitions per transaction and occurrences per definition in one tick
+RECURRING_BATCH_SIZE = 500
+RECURRING_MAX_CATCH_UP = 400
+
+# Archive: operations older than this move to operations_archive, this many per transaction
+ARCHIVE_AFTER_DAYS = 2 * 365
+ARCHIVE_BATCH_SIZE = 1000
+
+# Password hashing: the first scheme hashes new passwords, stored hashes under
+# other schemes or rounds are rehashed on login. Hashing runs on
+# PASSWORD_HASH_WORKERS threads per process, at most PASSWORD_HASH_QUEUE
+# in progress before logins get a 503, kept below the gunicorn threads so
+# a login burst leaves threads for other requests
+PASSWORD_SCHEMES = ['sha256_crypt']
+PASSWORD_ROUNDS = int(os.environ.get('PASSWORD_ROUNDS', 535000))
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_QUEUE = 4
+PASSWORD_HASH_TIMEOUT = 10
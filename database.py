@@ -0,0 +1,77 @@
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+import time
+
+
+REPLICA = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    # While a request reads from the replica (g.use_replica, set by
+    # views.read_only) queries go to the 'replica' bind. Flushes and
+    # everything else go to the primary
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('use_replica'):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    # Flask-SQLAlchemy with pool settings from the app config and an
+    # optional read replica (SQLALCHEMY_REPLICA_URI)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_POOL_SIZE', 10)
+        app.config.setdefault('DATABASE_MAX_OVERFLOW', 20)
+        app.config.setdefault('DATABASE_POOL_RECYCLE', 1800)
+        app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+        app.config.setdefault('SQLALCHEMY_REPLICA_URI', None)
+        app.config.setdefault('REPLICA_READ_YOUR_WRITES', 5)
+        app.config.setdefault('SQLALCHEMY_BINDS', None)
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+
+        replica = app.config['SQLALCHEMY_REPLICA_URI']
+        if replica:
+            app.config['SQLALCHEMY_BINDS'] = dict(app.config['SQLALCHEMY_BINDS'] or {}, **{REPLICA: replica})
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(pool_options(app.config), **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+        app.before_request(reset_routing)
+        app.after_request(remember_write)
+        super().init_app(app)
+
+
+def pool_options(config):
+    # SQLite gets its own pool from Flask-SQLAlchemy, the settings are for server databases
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or make_url(uri).drivername.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+
+def reset_routing():
+    g.pop('use_replica', None)
+
+
+def remember_write(response):
+    # A client that just changed something reads from the primary for
+    # REPLICA_READ_YOUR_WRITES seconds, the replica may not have it yet
+    config = current_app.config
+    if config['SQLALCHEMY_REPLICA_URI'] and request.method not in ('GET', 'HEAD', 'OPTIONS') \
+            and response.status_code < 400:
+        session['primary_until'] = time.time() + config['REPLICA_READ_YOUR_WRITES']
+    return response
+
+
+def replica_allowed():
+    return bool(current_app.config['SQLALCHEMY_REPLICA_URI']) and session.get('primary_until', 0) < time.time()
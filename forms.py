@@ -1,10 +1,27 @@
 from wtforms import Form
-from wtforms import StringField, BooleanField, TextAreaField, PasswordField, SelectField, DecimalField, HiddenField, FileField
-from wtforms.validators import InputRequired, Length, EqualTo, Email, DataRequired, regexp
-from decimal import Decimal
+from wtforms import StringField, BooleanField, TextAreaField, PasswordField, SelectField, DecimalField, HiddenField, FileField, DateField, IntegerField
+from wtforms.validators import InputRequired, Length, EqualTo, Email, DataRequired, Optional, NumberRange, regexp
+from decimal import Decimal, InvalidOperation
+from money import Money
 
 
 
+class MoneyField(DecimalField):
+    # Amount rounded to a cent as it is parsed, so balance and rollup
+    # deltas are computed from the value that is stored
+
+    def process_formdata(self, valuelist):
+        super().process_formdata(valuelist)
+        if self.data is not None:
+            try:
+                if not self.data.is_finite() or abs(self.data) > Money.MAX:
+                    raise InvalidOperation
+                self.data = Money.of(self.data)
+            except InvalidOperation:
+                self.data = None
+                raise ValueError(self.gettext('Not a valid amount'))
+
+
 # Forms
 class SignUpForm(Form):
     email = StringField('Email', [InputRequired(), Email(message='Email is not correct')])
@@ -29,11 +46,16 @@ class WalletForm(Form):
 
     name = StringField('Wallet Name', [InputRequired(), Length(min=4, max=30)])
     pay_type = SelectField('Wallet Type', choices=choices, validators=[InputRequired()])
-    balance = DecimalField('Balance', default=Decimal('0.00'), validators=[InputRequired()])
+    balance = MoneyField('Balance', default=Decimal('0.00'), validators=[InputRequired()])
+
+
+class EditWalletForm(WalletForm):
+    # Wallet version the form was rendered from
+    version = HiddenField('')
 
 
 class OperationForm(Form):
-    total = DecimalField('Total', default=Decimal('0.00'), validators=[InputRequired()])
+    total = MoneyField('Total', default=Decimal('0.00'), validators=[InputRequired()])
     category = SelectField('Category', coerce=int)
     type_id = HiddenField('')
     image = FileField('Image File')
@@ -45,5 +67,47 @@ class CategoryForm(Form):
     type_id = SelectField('Type', coerce=int)
 
 class TransferForm(Form):
-    total = DecimalField('Total', default=Decimal('0.00'), validators=[InputRequired()])
-    wallet = SelectField('Wallet', coerce=int)
\ No newline at end of file
+    total = MoneyField('Total', default=Decimal('0.00'), validators=[InputRequired()])
+    wallet = SelectField('Wallet', coerce=int)
+
+
+class ImportForm(Form):
+    choices = [
+        ('csv', 'CSV (date, amount, description, category)'),
+        ('ofx', 'OFX'),
+    ]
+
+    statement = FileField('Statement File')
+    statement_format = SelectField('Format', choices=choices, default='csv')
+
+
+class OperationFilterForm(Form):
+    wallet = SelectField('Wallet', coerce=int, default=0)
+    category = SelectField('Category', coerce=int, default=0)
+    type_id = SelectField('Type', coerce=int, default=0)
+    date_from = DateField('From', validators=[Optional()])
+    date_to = DateField('To', validators=[Optional()])
+
+
+class SearchForm(Form):
+    q = StringField('Search', validators=[Optional()])
+    min_total = DecimalField('Min Total', validators=[Optional()])
+    max_total = DecimalField('Max Total', validators=[Optional()])
+
+
+class RecurringOperationForm(Form):
+    choices = [
+        ('daily', 'day'),
+        ('weekly', 'week'),
+        ('monthly', 'month'),
+        ('yearly', 'year'),
+    ]
+
+    total = MoneyField('Total', default=Decimal('0.00'), validators=[InputRequired(), NumberRange(min=Decimal('0.01'))])
+    type_id = SelectField('Type', coerce=int)
+    category = SelectField('Category', coerce=int, default=0)
+    description = StringField('Description', validators=[Optional(), Length(max=150)])
+    interval = IntegerField('Every', default=1, validators=[InputRequired(), NumberRange(min=1, max=366)])
+    period = SelectField('Period', choices=choices, default='monthly')
+    starts = DateField('First Date', validators=[InputRequired()])
+    ends = DateField('Last Date', validators=[Optional()])
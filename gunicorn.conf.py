@@ -0,0 +1,28 @@
+# Used with: gunicorn --config gunicorn.conf.py wsgi:app
+import gc
+import os
+
+
+preload_app = True
+# Threaded workers: a login waiting on the password hash pool
+# (PASSWORD_HASH_WORKERS) only holds one thread, the others keep serving.
+# Each thread may hold a database connection, so threads stay below
+# DATABASE_POOL_SIZE, and PASSWORD_HASH_QUEUE below threads
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def pre_fork(server, worker):
+    # Objects created while preloading are moved out of the collector's
+    # reach, so a collection in a worker doesn't write to (and copy) the
+    # master's pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared between workers
+    from app import db
+    from wsgi import app
+
+    with app.app_context():
+        db.engine.dispose()
@@ -0,0 +1,130 @@
+from app import db
+from models import Category, OperationBatch, types
+from money import Money
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import csv
+import re
+
+
+class StatementError(ValueError):
+    pass
+
+
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d.%m.%Y', '%Y%m%d')
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def parse_amount(value, line):
+    try:
+        amount = Decimal(value.strip().replace(',', '.'))
+    except (InvalidOperation, AttributeError):
+        raise StatementError(f'Line {line}: wrong amount {value!r}')
+    # NaN and Infinity parse, but can't be compared or stored
+    if not amount.is_finite() or abs(amount) > Money.MAX:
+        raise StatementError(f'Line {line}: wrong amount {value!r}')
+    return amount
+
+
+def parse_date(value, line):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format)
+        except (ValueError, AttributeError):
+            continue
+    raise StatementError(f'Line {line}: wrong date {value!r}')
+
+
+def parse_csv(stream):
+    # date,amount,description,category rows; negative amounts are expenses
+    reader = csv.DictReader(stream)
+    if not reader.fieldnames or not {'date', 'amount'} <= set(reader.fieldnames):
+        raise StatementError('CSV header must contain date and amount columns')
+
+    for line, row in enumerate(reader, start=2):
+        yield (
+            parse_date(row['date'], line),
+            parse_amount(row['amount'], line),
+            row.get('description') or None,
+            row.get('category') or None,
+        )
+
+
+def parse_ofx(stream, chunk_size=64 * 1024):
+    # OFX 1.x (SGML) and 2.x (XML) statements, one operation per <STMTTRN>.
+    # Read in chunks, a tag cut at the end of a chunk waits for the next one
+    buffer = ''
+    transaction = None
+    number = 0
+
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        cut = buffer.rfind('<') if chunk else len(buffer)
+        text, buffer = buffer[:cut], buffer[cut:]
+
+        for closing, tag, value in OFX_TAG.findall(text):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and transaction is not None:
+                    number += 1
+                    yield (
+                        parse_date(transaction.get('DTPOSTED', '')[:8], number),
+                        parse_amount(transaction.get('TRNAMT'), number),
+                        ' '.join(filter(None, (transaction.get('NAME'), transaction.get('MEMO')))) or None,
+                        transaction.get('NAME'),
+                    )
+                transaction = None if closing else {}
+            elif transaction is not None and not closing:
+                transaction[tag] = value.strip()
+
+        if not chunk:
+            break
+
+
+PARSERS = {
+    'csv': parse_csv,
+    'ofx': parse_ofx,
+}
+
+
+def import_statement(user_id, wallet_id, stream, statement_format='csv', chunk_size=1000):
+    # Streams the statement into the wallet in one transaction, returns number of operations
+    parse = PARSERS.get(statement_format)
+    if parse is None:
+        raise StatementError(f'Unknown statement format {statement_format!r}')
+
+    categories = {
+        (name.lower(), type_id): id
+        for id, name, type_id in db.session.query(Category.id, Category.name, Category.type_id)
+            .filter(Category.user_id == user_id)
+    }
+    batch = OperationBatch(user_id=user_id, chunk_size=chunk_size)
+
+    try:
+        for created, amount, description, category in parse(stream):
+            type_id = types.id('income') if amount >= 0 else types.id('expense')
+
+            category_id = None
+            if category:
+                category_id = categories.get((category.strip().lower(), type_id))
+                # CSV categories the user doesn't have yet are created, OFX payees are only matched
+                if category_id is None and statement_format == 'csv':
+                    new_category = Category(name=category.strip()[:30], type_id=type_id, user_id=user_id)
+                    db.session.add(new_category)
+                    db.session.flush()
+                    category_id = categories[(category.strip().lower(), type_id)] = new_category.id
+
+            batch.add(
+                wallet_id=wallet_id,
+                type_id=type_id,
+                total=abs(amount),
+                category_id=category_id,
+                description=description and description[:150],
+                created=created,
+            )
+
+        return batch.commit()
+    except Exception:
+        db.session.rollback()
+        raise
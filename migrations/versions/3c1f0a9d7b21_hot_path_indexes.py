@@ -0,0 +1,34 @@
+"""Indexes for the hot query paths
+
+Revision ID: 3c1f0a9d7b21
+Revises: 5d2e8b1a7c40
+Create Date: 2026-10-18 10:12:41.305218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0a9d7b21'
+down_revision = '5d2e8b1a7c40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_wallets_user_id', 'wallets', ['user_id'])
+    op.create_index(
+        'ix_operations_wallet_id_created',
+        'operations',
+        ['wallet_id', sa.text('created DESC'), sa.text('id DESC')],
+    )
+    op.create_index('ix_operations_category_id', 'operations', ['category_id'])
+    op.create_index('ix_categories_user_id_type_id', 'categories', ['user_id', 'type_id'])
+
+
+def downgrade():
+    op.drop_index('ix_categories_user_id_type_id', table_name='categories')
+    op.drop_index('ix_operations_category_id', table_name='operations')
+    op.drop_index('ix_operations_wallet_id_created', table_name='operations')
+    op.drop_index('ix_wallets_user_id', table_name='wallets')
@@ -0,0 +1,91 @@
+"""Operation summaries rollup and wallet versions
+
+First revision: the baseline schema (users, wallets, operations,
+categories, types) was created by db.create_all() before migrations
+existed, `flask db upgrade` takes it from there.
+
+Revision ID: 5d2e8b1a7c40
+Revises:
+Create Date: 2026-10-18 09:48:03.571620
+
+"""
+from alembic import op
+from datetime import date
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8b1a7c40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    summaries = op.create_table(
+        'operation_summaries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('wallet_id', sa.Integer(), nullable=False),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.Column('type_id', sa.Integer(), nullable=False),
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('total', sa.DECIMAL(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['category_id'], ['categories.id'], onupdate='CASCADE', ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['type_id'], ['types.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'wallet_id', 'category_id', 'type_id', 'month'),
+    )
+    with op.batch_alter_table('wallets') as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+    # Backfill the rollup from existing operations, as rebuild-summaries does
+    wallets = sa.table('wallets', sa.column('id'), sa.column('user_id'))
+    operations = sa.table(
+        'operations',
+        sa.column('id'), sa.column('wallet_id'), sa.column('category_id'),
+        sa.column('type_id'), sa.column('total'), sa.column('created'),
+    )
+    year = sa.extract('year', operations.c.created)
+    month = sa.extract('month', operations.c.created)
+    query = sa.select([
+            wallets.c.user_id,
+            operations.c.wallet_id,
+            operations.c.category_id,
+            operations.c.type_id,
+            year,
+            month,
+            sa.func.sum(operations.c.total),
+            sa.func.count(operations.c.id),
+        ]) \
+        .select_from(operations.join(wallets, operations.c.wallet_id == wallets.c.id)) \
+        .where(wallets.c.user_id.isnot(None)) \
+        .where(operations.c.type_id.isnot(None)) \
+        .where(operations.c.created.isnot(None)) \
+        .group_by(
+            wallets.c.user_id, operations.c.wallet_id, operations.c.category_id, operations.c.type_id, year, month
+        )
+
+    rows = [
+        {
+            'user_id': user_id,
+            'wallet_id': wallet_id,
+            'category_id': category_id,
+            'type_id': type_id,
+            'month': date(int(y), int(m), 1),
+            'total': total or 0,
+            'count': count,
+        }
+        for user_id, wallet_id, category_id, type_id, y, m, total, count in op.get_bind().execute(query)
+    ]
+    if rows:
+        op.bulk_insert(summaries, rows)
+
+
+def downgrade():
+    with op.batch_alter_table('wallets') as batch_op:
+        batch_op.drop_column('version')
+    op.drop_table('operation_summaries')
@@ -0,0 +1,94 @@
+"""Full-text search index over operations
+
+Revision ID: 8e4d2b6c1f05
+Revises: 3c1f0a9d7b21
+Create Date: 2026-10-18 12:40:07.118431
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4d2b6c1f05'
+down_revision = '3c1f0a9d7b21'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS operations_fts USING fts5(description, category, wallet)",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_insert AFTER INSERT ON operations BEGIN
+        INSERT INTO operations_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_update
+    AFTER UPDATE OF description, category_id, wallet_id ON operations BEGIN
+        DELETE FROM operations_fts WHERE rowid = old.id;
+        INSERT INTO operations_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_delete AFTER DELETE ON operations BEGIN
+        DELETE FROM operations_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_fts_rename AFTER UPDATE OF name ON categories BEGIN
+        UPDATE operations_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM operations WHERE category_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS wallets_fts_rename AFTER UPDATE OF name ON wallets BEGIN
+        UPDATE operations_fts SET wallet = new.name
+        WHERE rowid IN (SELECT id FROM operations WHERE wallet_id = new.id);
+    END""",
+]
+
+SQLITE_REINDEX = [
+    "DELETE FROM operations_fts",
+    """INSERT INTO operations_fts (rowid, description, category, wallet)
+    SELECT operations.id, coalesce(operations.description, ''), coalesce(categories.name, ''), coalesce(wallets.name, '')
+    FROM operations
+    LEFT OUTER JOIN categories ON categories.id = operations.category_id
+    LEFT OUTER JOIN wallets ON wallets.id = operations.wallet_id""",
+]
+
+MYSQL_INDEX = ["CREATE FULLTEXT INDEX ix_operations_description_ft ON operations (description)"]
+POSTGRES_INDEX = [
+    "CREATE INDEX ix_operations_description_ft ON operations "
+    "USING gin (to_tsvector('simple', coalesce(description, '')))"
+]
+
+
+SQLITE_TRIGGERS = [
+    'operations_fts_insert',
+    'operations_fts_update',
+    'operations_fts_delete',
+    'categories_fts_rename',
+    'wallets_fts_rename',
+]
+
+
+def upgrade():
+    statements = {
+        'sqlite': SQLITE_INDEX + SQLITE_REINDEX,
+        'mysql': MYSQL_INDEX,
+        'postgresql': POSTGRES_INDEX,
+    }
+    for statement in statements.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for trigger in SQLITE_TRIGGERS:
+            op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        op.execute('DROP TABLE IF EXISTS operations_fts')
+    elif dialect in ('mysql', 'postgresql'):
+        op.drop_index('ix_operations_description_ft', table_name='operations')
@@ -0,0 +1,53 @@
+"""Operations archive
+
+Revision ID: a8d3e6f0c152
+Revises: f2b6d9e4a310
+Create Date: 2026-10-18 20:41:37.209514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d3e6f0c152'
+down_revision = 'f2b6d9e4a310'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'operations_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('total', sa.DECIMAL(), nullable=True),
+        sa.Column('type_id', sa.Integer(), nullable=True),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.Column('wallet_id', sa.Integer(), nullable=True),
+        sa.Column('filename', sa.String(length=255), nullable=True),
+        sa.Column('description', sa.String(length=150), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['type_id'], ['types.id']),
+        sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'ix_operations_archive_wallet_id_created',
+        'operations_archive',
+        ['wallet_id', sa.text('created DESC'), sa.text('id DESC')],
+    )
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('archived_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    # Archived operations go back to the hot table first
+    op.execute(
+        'INSERT INTO operations (id, total, type_id, category_id, wallet_id, filename, description, created) '
+        'SELECT id, total, type_id, category_id, wallet_id, filename, description, created FROM operations_archive'
+    )
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('archived_until')
+    op.drop_index('ix_operations_archive_wallet_id_created', table_name='operations_archive')
+    op.drop_table('operations_archive')
@@ -0,0 +1,28 @@
+"""Per-user data version for caching and conditional GET
+
+Revision ID: b7a93e2d4c18
+Revises: 8e4d2b6c1f05
+Create Date: 2026-10-18 14:05:52.640913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7a93e2d4c18'
+down_revision = '8e4d2b6c1f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('data_version', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('data_updated', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('data_updated')
+        batch_op.drop_column('data_version')
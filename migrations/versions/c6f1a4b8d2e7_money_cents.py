@@ -0,0 +1,78 @@
+"""Money as integer cents
+
+Revision ID: c6f1a4b8d2e7
+Revises: a8d3e6f0c152
+Create Date: 2026-10-18 22:05:13.604871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f1a4b8d2e7'
+down_revision = 'a8d3e6f0c152'
+branch_labels = None
+depends_on = None
+
+
+# (table, column, nullable)
+MONEY_COLUMNS = [
+    ('wallets', 'balance', True),
+    ('operations', 'total', True),
+    ('operations_archive', 'total', True),
+    ('operation_summaries', 'total', False),
+    ('ledger_entries', 'amount', False),
+    ('balance_snapshots', 'balance', False),
+    ('recurring_operations', 'total', False),
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column, nullable in MONEY_COLUMNS:
+        if dialect == 'postgresql':
+            op.alter_column(
+                table, column,
+                type_=sa.BigInteger(),
+                existing_type=sa.DECIMAL(),
+                existing_nullable=nullable,
+                postgresql_using=f'round({column} * 100)::bigint',
+            )
+            continue
+
+        # SQLite keeps the integers in the NUMERIC column as they are, and
+        # rebuilding the tables in batch mode would drop the search triggers.
+        # Elsewhere the column becomes BIGINT before it's multiplied: MySQL's
+        # DECIMAL is DECIMAL(10,0) and would overflow from 1e8 on
+        if dialect != 'sqlite':
+            op.alter_column(
+                table, column,
+                type_=sa.BigInteger(),
+                existing_type=sa.DECIMAL(),
+                existing_nullable=nullable,
+            )
+        op.execute(f'UPDATE {table} SET {column} = ROUND({column} * 100)')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column, nullable in MONEY_COLUMNS:
+        if dialect == 'postgresql':
+            op.alter_column(
+                table, column,
+                type_=sa.DECIMAL(),
+                existing_type=sa.BigInteger(),
+                existing_nullable=nullable,
+                postgresql_using=f'{column} / 100.0',
+            )
+            continue
+
+        if dialect != 'sqlite':
+            op.alter_column(
+                table, column,
+                type_=sa.DECIMAL(),
+                existing_type=sa.BigInteger(),
+                existing_nullable=nullable,
+            )
+        op.execute(f'UPDATE {table} SET {column} = {column} / 100.0')
@@ -0,0 +1,57 @@
+"""Balance ledger and snapshots
+
+Revision ID: e5a8c3f1b907
+Revises: d41c7f9a2e63
+Create Date: 2026-10-18 16:12:40.118305
+
+"""
+from alembic import op
+from datetime import datetime
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a8c3f1b907'
+down_revision = 'd41c7f9a2e63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ledger_entries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('wallet_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.DECIMAL(), nullable=False),
+        sa.Column('reason', sa.String(length=20), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_ledger_entries_wallet_id_created', 'ledger_entries', ['wallet_id', 'created'])
+    op.create_table(
+        'balance_snapshots',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('wallet_id', sa.Integer(), nullable=False),
+        sa.Column('taken_at', sa.DateTime(), nullable=False),
+        sa.Column('balance', sa.DECIMAL(), nullable=False),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('wallet_id', 'taken_at'),
+    )
+
+    # Existing balances open the ledger, there is no history before them
+    op.get_bind().execute(
+        sa.text(
+            "INSERT INTO ledger_entries (wallet_id, amount, reason, created) "
+            "SELECT id, balance, 'opening', :now FROM wallets "
+            "WHERE balance IS NOT NULL AND balance <> 0"
+        ),
+        now=datetime.now(),
+    )
+
+
+def downgrade():
+    op.drop_table('balance_snapshots')
+    op.drop_index('ix_ledger_entries_wallet_id_created', table_name='ledger_entries')
+    op.drop_table('ledger_entries')
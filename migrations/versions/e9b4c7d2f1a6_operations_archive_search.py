@@ -0,0 +1,92 @@
+"""Search index over archived operations
+
+Revision ID: e9b4c7d2f1a6
+Revises: c6f1a4b8d2e7
+Create Date: 2026-10-19 10:21:36.402819
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9b4c7d2f1a6'
+down_revision = 'c6f1a4b8d2e7'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS operations_archive_fts USING fts5(description, category, wallet)",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_insert AFTER INSERT ON operations_archive BEGIN
+        INSERT INTO operations_archive_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_update
+    AFTER UPDATE OF category_id ON operations_archive BEGIN
+        UPDATE operations_archive_fts
+        SET category = coalesce((SELECT name FROM categories WHERE id = new.category_id), '')
+        WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_delete AFTER DELETE ON operations_archive BEGIN
+        DELETE FROM operations_archive_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_archive_fts_rename AFTER UPDATE OF name ON categories BEGIN
+        UPDATE operations_archive_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM operations_archive WHERE category_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS wallets_archive_fts_rename AFTER UPDATE OF name ON wallets BEGIN
+        UPDATE operations_archive_fts SET wallet = new.name
+        WHERE rowid IN (SELECT id FROM operations_archive WHERE wallet_id = new.id);
+    END""",
+]
+
+# Operations archived before this revision were dropped from operations_fts
+SQLITE_REINDEX = [
+    "DELETE FROM operations_archive_fts",
+    """INSERT INTO operations_archive_fts (rowid, description, category, wallet)
+    SELECT operations_archive.id, coalesce(operations_archive.description, ''),
+        coalesce(categories.name, ''), coalesce(wallets.name, '')
+    FROM operations_archive
+    LEFT OUTER JOIN categories ON categories.id = operations_archive.category_id
+    LEFT OUTER JOIN wallets ON wallets.id = operations_archive.wallet_id""",
+]
+
+MYSQL_INDEX = ["CREATE FULLTEXT INDEX ix_operations_archive_description_ft ON operations_archive (description)"]
+POSTGRES_INDEX = [
+    "CREATE INDEX ix_operations_archive_description_ft ON operations_archive "
+    "USING gin (to_tsvector('simple', coalesce(description, '')))"
+]
+
+
+SQLITE_TRIGGERS = [
+    'operations_archive_fts_insert',
+    'operations_archive_fts_update',
+    'operations_archive_fts_delete',
+    'categories_archive_fts_rename',
+    'wallets_archive_fts_rename',
+]
+
+
+def upgrade():
+    statements = {
+        'sqlite': SQLITE_INDEX + SQLITE_REINDEX,
+        'mysql': MYSQL_INDEX,
+        'postgresql': POSTGRES_INDEX,
+    }
+    for statement in statements.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for trigger in SQLITE_TRIGGERS:
+            op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        op.execute('DROP TABLE IF EXISTS operations_archive_fts')
+    elif dialect in ('mysql', 'postgresql'):
+        op.drop_index('ix_operations_archive_description_ft', table_name='operations_archive')
@@ -0,0 +1,50 @@
+"""Recurring operations
+
+Revision ID: f2b6d9e4a310
+Revises: e5a8c3f1b907
+Create Date: 2026-10-18 17:05:11.482730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d9e4a310'
+down_revision = 'e5a8c3f1b907'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'recurring_operations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('wallet_id', sa.Integer(), nullable=False),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.Column('type_id', sa.Integer(), nullable=False),
+        sa.Column('total', sa.DECIMAL(), nullable=False),
+        sa.Column('description', sa.String(length=150), nullable=True),
+        sa.Column('period', sa.String(length=10), nullable=False),
+        sa.Column('interval', sa.Integer(), nullable=False),
+        sa.Column('starts', sa.DateTime(), nullable=False),
+        sa.Column('ends', sa.DateTime(), nullable=True),
+        sa.Column('runs', sa.Integer(), nullable=False),
+        sa.Column('next_run', sa.DateTime(), nullable=False),
+        sa.Column('active', sa.Boolean(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['category_id'], ['categories.id'], onupdate='CASCADE', ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['type_id'], ['types.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_recurring_operations_active_next_run', 'recurring_operations', ['active', 'next_run'])
+    op.create_index('ix_recurring_operations_user_id', 'recurring_operations', ['user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_recurring_operations_user_id', table_name='recurring_operations')
+    op.drop_index('ix_recurring_operations_active_next_run', table_name='recurring_operations')
+    op.drop_table('recurring_operations')
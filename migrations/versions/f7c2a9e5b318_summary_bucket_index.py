@@ -0,0 +1,53 @@
+"""Unique index over rollup buckets, uncategorized included
+
+Revision ID: f7c2a9e5b318
+Revises: e9b4c7d2f1a6
+Create Date: 2026-10-19 14:37:52.906114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7c2a9e5b318'
+down_revision = 'e9b4c7d2f1a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Uncategorized buckets could repeat before, merge them into one row each
+    summaries = sa.table(
+        'operation_summaries',
+        sa.column('id'), sa.column('user_id'), sa.column('wallet_id'), sa.column('category_id'),
+        sa.column('type_id'), sa.column('month'), sa.column('total'), sa.column('count'),
+    )
+    key = [summaries.c.user_id, summaries.c.wallet_id, summaries.c.type_id, summaries.c.month]
+    bind = op.get_bind()
+    duplicates = bind.execute(
+        sa.select(key + [sa.func.min(summaries.c.id), sa.func.sum(summaries.c.total), sa.func.sum(summaries.c.count)])
+            .where(summaries.c.category_id.is_(None))
+            .group_by(*key)
+            .having(sa.func.count() > 1)
+    ).fetchall()
+    for user_id, wallet_id, type_id, month, keep, total, count in duplicates:
+        bucket = sa.and_(
+            summaries.c.user_id == user_id,
+            summaries.c.wallet_id == wallet_id,
+            summaries.c.category_id.is_(None),
+            summaries.c.type_id == type_id,
+            summaries.c.month == month,
+        )
+        bind.execute(summaries.delete().where(bucket).where(summaries.c.id != keep))
+        bind.execute(summaries.update().where(summaries.c.id == keep).values(total=total, count=count))
+
+    # Parenthesized so MySQL (8.0.13+) takes it as a functional key part
+    op.execute(
+        'CREATE UNIQUE INDEX uq_operation_summaries_bucket ON operation_summaries '
+        '(user_id, wallet_id, (coalesce(category_id, 0)), type_id, month)'
+    )
+
+
+def downgrade():
+    op.drop_index('uq_operation_summaries_bucket', table_name='operation_summaries')
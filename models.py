@@ -1,7 +1,22 @@
-from app import db
-from datetime import datetime
+from app import db, cache
+from collections import namedtuple
+from datetime import datetime, timedelta
 from decimal import Decimal
+from money import Money, MoneyType
+import calendar
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.sql.elements import Grouping
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+import threading
+
+
+# Dashboard totals computed in SQL
+Summary = namedtuple('Summary', ['balance', 'income_sum', 'expenses_sum'])
+
+# One page of the operations listing and the (created, id) key to continue after it
+OperationsPage = namedtuple('OperationsPage', ['operations', 'next_cursor'])
 
 
 # Models
@@ -16,40 +31,251 @@ class User(db.Model, UserMixin):
     wallets = db.relationship('Wallet', backref='user', lazy=True)
     categories = db.relationship('Category', backref='user', lazy=True)
 
-    created = db.Column(db.DateTime, default=datetime.now())
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    # Bumped by every write the user can see, drives page caching and ETags
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    data_updated = db.Column(db.DateTime)
+    # Newest created of the user's archived operations, None while nothing is archived
+    archived_until = db.Column(db.DateTime)
+
+    # Columns kept in the session identity cache. data_version and
+    # data_updated are left out, they change with every write (bulk ones
+    # from other processes too) and an ETag must never be built from an old one
+    IDENTITY_COLUMNS = ('id', 'email', 'username', 'created')
+
+    @staticmethod
+    def identity_cache_key(user_id):
+        return f'identity:{user_id}'
+
+    @classmethod
+    def load_identity(cls, user_id, ttl=None):
+        # For the login manager: the user and their wallet ids, from the
+        # cache without a query. The user is attached to the session as if
+        # it had been loaded, columns that aren't cached load on first access
+        user = db.session.identity_map.get(identity_key(cls, user_id))
+        if user is not None:
+            return user
+
+        identity = cache.get(cls.identity_cache_key(user_id))
+        if identity is None:
+            user = cls.query.get(user_id)
+            if user is None:
+                return None
+            identity = {name: getattr(user, name) for name in cls.IDENTITY_COLUMNS}
+            identity['wallet_ids'] = user.load_wallet_ids()
+            cache.set(cls.identity_cache_key(user_id), identity, ttl)
+            return user
+
+        columns = dict(identity)
+        wallet_ids = columns.pop('wallet_ids')
+        user = cls(**columns)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        user._wallet_ids = wallet_ids
+        return user
+
+    @staticmethod
+    def forget_identities(user_ids):
+        for user_id in user_ids:
+            cache.delete(User.identity_cache_key(user_id))
+
+    @property
+    def wallet_ids(self):
+        # Cached with the identity, may lag behind wallets created or
+        # deleted by another worker until it expires. For display only,
+        # writes check ownership in the database
+        wallet_ids = getattr(self, '_wallet_ids', None)
+        if wallet_ids is None:
+            wallet_ids = self.load_wallet_ids()
+        return wallet_ids
+
+    def load_wallet_ids(self):
+        self._wallet_ids = [id for id, in db.session.query(Wallet.id).filter(Wallet.user_id == self.id).order_by(Wallet.id)]
+        return self._wallet_ids
+
+    def touch(self):
+        # Part of the caller's transaction
+        User.touch_all([self.id])
+        db.session.expire(self, ['data_version', 'data_updated'])
+
+    @staticmethod
+    def touch_all(user_ids):
+        # Bumps the data version of many users in one statement
+        User.query \
+            .filter(User.id.in_(user_ids)) \
+            .update({
+                User.data_version: User.data_version + 1,
+                User.data_updated: datetime.now(),
+            }, synchronize_session=False)
 
     def get_wallets(self):
-        wallets = db.session.query(Wallet).join(User).filter(User.username == self.username).all()
-        return wallets
+        return Wallet.query.filter(Wallet.user_id == self.id).all()
+
+    def get_summary(self):
+        # Balance from wallets, income and expenses from the monthly rollup, in one statement
+        balance = db.session.query(db.func.coalesce(db.func.sum(Wallet.balance), 0)) \
+            .filter(Wallet.user_id == self.id) \
+            .as_scalar()
+        income_sum = db.func.sum(db.case([(OperationSummary.type_id == types.id('income'), OperationSummary.total)], else_=0))
+        expenses_sum = db.func.sum(db.case([(OperationSummary.type_id == types.id('expense'), OperationSummary.total)], else_=0))
+
+        row = db.session.query(
+                balance,
+                db.func.coalesce(income_sum, 0),
+                db.func.coalesce(expenses_sum, 0),
+            ) \
+            .select_from(OperationSummary) \
+            .filter(OperationSummary.user_id == self.id) \
+            .one()
+
+        return Summary(*(Decimal(value or 0) for value in row))
+
+    def get_monthly_report(self):
+        # [(month, type name, total, count)] newest month first
+        report = db.session.query(
+                OperationSummary.month,
+                Type.name,
+                db.func.sum(OperationSummary.total),
+                db.func.sum(OperationSummary.count),
+            ) \
+            .join(Type, OperationSummary.type_id == Type.id) \
+            .filter(OperationSummary.user_id == self.id) \
+            .group_by(OperationSummary.month, Type.name) \
+            .order_by(OperationSummary.month.desc(), Type.name) \
+            .all()
+        return report
+
+    def get_category_report(self, month=None):
+        # [(category name, type name, total, count)], optionally for a single month
+        report = db.session.query(
+                Category.name,
+                Type.name,
+                db.func.sum(OperationSummary.total),
+                db.func.sum(OperationSummary.count),
+            ) \
+            .select_from(OperationSummary) \
+            .outerjoin(Category, OperationSummary.category_id == Category.id) \
+            .join(Type, OperationSummary.type_id == Type.id) \
+            .filter(OperationSummary.user_id == self.id)
+        if month is not None:
+            report = report.filter(OperationSummary.month == month)
+
+        report = report \
+            .group_by(OperationSummary.category_id, Category.name, Type.name) \
+            .order_by(Type.name, db.func.sum(OperationSummary.total).desc()) \
+            .all()
+        return report
 
     def get_balance(self):
-        wallets = self.get_wallets()
-        balance = sum(map((lambda wallet: wallet.balance), wallets))
-        return balance
+        return self.get_summary().balance
+
+    def needs_archive(self, date_from=None):
+        # Whether reading back to date_from (the whole history without one)
+        # can reach archived operations
+        if self.archived_until is None:
+            return False
+        if date_from is None:
+            return True
+        return datetime(date_from.year, date_from.month, date_from.day) <= self.archived_until
+
+    def query_operations(self, model=None):
+        # All user operations newest first, category loaded in the same query (types come from the cache).
+        # model is Operation (default) or ArchivedOperation
+        model = model or Operation
+        operations = model.query \
+            .join(Wallet, model.wallet_id == Wallet.id) \
+            .filter(Wallet.user_id == self.id) \
+            .options(joinedload(model.category)) \
+            .order_by(model.created.desc(), model.id.desc())
+        return operations
 
-    def get_operations(self):
-        wallets = self.get_wallets()
-        # List of lists
-        operations = list(map((lambda wallet: wallet.operations), wallets))
-        # Making flat list
-        flat_operations = [op for ops in operations for op in ops]
-        # Sort operations descending
-        flat_operations.sort(key=lambda x: x.created, reverse=True)
+    def merge_archived(self, rows, archived_query, limit=None):
+        # Archived operations are all older than archived_until, so they are
+        # only read when the hot rows run out before `limit` or reach back that far
+        if limit is not None and len(rows) >= limit and rows[-1].created > self.archived_until:
+            return rows
+        if limit is not None:
+            archived_query = archived_query.limit(limit)
+        rows = sorted(rows + archived_query.all(), key=lambda op: (op.created, op.id), reverse=True)
+        return rows[:limit] if limit is not None else rows
 
-        return flat_operations
+    def get_operations(self, limit=None):
+        operations = self.query_operations()
+        if limit is not None:
+            operations = operations.limit(limit)
+
+        rows = operations.all()
+        if self.needs_archive():
+            rows = self.merge_archived(rows, self.query_operations(ArchivedOperation), limit)
+        return rows
+
+    def get_operations_page(self, cursor=None, per_page=20, wallet_id=None, category_id=None,
+                            type_id=None, date_from=None, date_to=None):
+        def page_query(model):
+            operations = self.query_operations(model)
+
+            if wallet_id:
+                operations = operations.filter(model.wallet_id == wallet_id)
+            if category_id:
+                operations = operations.filter(model.category_id == category_id)
+            if type_id:
+                operations = operations.filter(model.type_id == type_id)
+            if date_from:
+                operations = operations.filter(model.created >= date_from)
+            if date_to:
+                # date_to is inclusive
+                operations = operations.filter(model.created < date_to + timedelta(days=1))
+
+            # Keyset pagination: continue strictly after the last (created, id) seen.
+            # Archived operations keep their ids, so one cursor spans both tables
+            if cursor:
+                created, op_id = cursor
+                operations = operations.filter(db.or_(
+                    model.created < created,
+                    db.and_(model.created == created, model.id < op_id),
+                ))
+            return operations
+
+        # One extra row tells whether there is a next page
+        rows = page_query(Operation).limit(per_page + 1).all()
+        if self.needs_archive(date_from):
+            rows = self.merge_archived(rows, page_query(ArchivedOperation), per_page + 1)
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = (rows[-1].created, rows[-1].id)
+
+        return OperationsPage(rows, next_cursor)
+
+    def iter_operation_rows(self, batch_size=1000):
+        # Flat (id, created, wallet, category, type, total, description) rows
+        # streamed from a server-side cursor, oldest first, archived ones included
+        def rows_of(model):
+            return db.session.query(
+                    model.id.label('id'),
+                    model.created.label('created'),
+                    Wallet.name,
+                    Category.name,
+                    Type.name,
+                    model.total,
+                    model.description,
+                ) \
+                .join(Wallet, model.wallet_id == Wallet.id) \
+                .outerjoin(Category, model.category_id == Category.id) \
+                .join(Type, model.type_id == Type.id) \
+                .filter(Wallet.user_id == self.id)
+
+        rows = rows_of(Operation)
+        if self.needs_archive():
+            rows = rows.union_all(rows_of(ArchivedOperation))
+        return rows.order_by(db.literal_column('created'), db.literal_column('id')).yield_per(batch_size)
 
     def get_income_sum(self):
-        operations = self.get_operations()
-        income_ops = list(filter((lambda operation: operation.op_type.name == 'income'), operations))
-        # Count sum...
-        income_sum = sum(map((lambda operation: operation.total), income_ops))
-        return income_sum
+        return self.get_summary().income_sum
 
     def get_expenses_sum(self):
-        operations = self.get_operations()
-        expenses_ops = list(filter((lambda operation: operation.op_type.name == 'expense'), operations))
-        expenses_sum = sum(map((lambda operation: operation.total), expenses_ops))
-        return expenses_sum
+        return self.get_summary().expenses_sum
 
     def get_all_categories(self):
         all_categories = db.session.query(Category).join(User).filter(Category.user_id == self.id).all()
@@ -65,24 +291,75 @@ class Wallet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     pay_type = db.Column(db.String(30), default='cash')
-    balance = db.Column(db.DECIMAL, default=Decimal('0.00'))
+    balance = db.Column(MoneyType, default=Money('0.00'))
 
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'))
 
     operations = db.relationship('Operation', backref='wallet', lazy=True)
 
-    created = db.Column(db.DateTime, default=datetime.now())
+    created = db.Column(db.DateTime, default=datetime.now)
 
-    def change_balance(self, op_type_id, amount):
-        op_type = Type.query.get(op_type_id)
+    # Bumped on every balance change, ORM updates of a stale row raise StaleDataError
+    version = db.Column(db.Integer, nullable=False, default=1)
 
-        types = {
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        db.Index('ix_wallets_user_id', user_id),
+    )
+
+    @staticmethod
+    def balance_delta(op_type_id, amount):
+        deltas = {
             'income': Decimal(amount),
             'expense': Decimal(-amount),
         }
 
-        self.balance += types[op_type.name]
+        return deltas[types.name(op_type_id)]
+
+    @classmethod
+    def apply_deltas(cls, deltas, reason='operation'):
+        # deltas: {wallet_id: amount}. Each wallet gets one atomic
+        # UPDATE wallets SET balance = balance + :delta, in id order so
+        # concurrent transfers between the same wallets can't deadlock.
+        # The deltas are appended to the ledger in the same transaction
+        entries = []
+        for wallet_id in sorted(deltas):
+            delta = deltas[wallet_id]
+            if not delta:
+                continue
+            entries.append({'wallet_id': wallet_id, 'amount': delta, 'reason': reason, 'created': datetime.now()})
+            db.session.query(cls) \
+                .filter(cls.id == wallet_id) \
+                .update({
+                    cls.balance: cls.balance + delta,
+                    cls.version: cls.version + 1,
+                }, synchronize_session=False)
 
+            # Loaded copy is stale now, reload it on next access
+            wallet = db.session.identity_map.get(identity_key(cls, wallet_id))
+            if wallet is not None:
+                db.session.expire(wallet, ['balance', 'version'])
+
+        if entries:
+            db.session.execute(LedgerEntry.__table__.insert(), entries)
+
+    def change_balance(self, op_type_id, amount):
+        Wallet.apply_deltas({self.id: Wallet.balance_delta(op_type_id, amount)})
+
+    def balance_at(self, moment):
+        # Balance as it was at `moment`: the latest snapshot taken by then
+        # plus the ledger entries recorded between the two
+        snapshot = BalanceSnapshot.query \
+            .filter(BalanceSnapshot.wallet_id == self.id, BalanceSnapshot.taken_at <= moment) \
+            .order_by(BalanceSnapshot.taken_at.desc()) \
+            .first()
+
+        entries = db.session.query(db.func.coalesce(db.func.sum(LedgerEntry.amount), 0)) \
+            .filter(LedgerEntry.wallet_id == self.id, LedgerEntry.created <= moment)
+        if snapshot is not None:
+            entries = entries.filter(LedgerEntry.created >= snapshot.taken_at)
+        balance = Decimal(entries.scalar())
+        return balance + snapshot.balance if snapshot is not None else balance
 
     def __repr__(self):
         return f'<Wallet id: {self.id}, name: {self.name}, user_id: {self.user_id}>'
@@ -92,7 +369,7 @@ class Operation(db.Model):
     __tablename__ = 'operations'
 
     id = db.Column(db.Integer, primary_key=True)
-    total = db.Column(db.DECIMAL, default=Decimal('0.00'))
+    total = db.Column(MoneyType, default=Money('0.00'))
     type_id = db.Column(db.Integer, db.ForeignKey('types.id'))
 
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
@@ -102,20 +379,106 @@ class Operation(db.Model):
     filename = db.Column(db.String(255))
     description = db.Column(db.String(150))
 
-    created = db.Column(db.DateTime, default=datetime.now())
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        # Per-wallet history newest first: listings, dashboard, keyset pages
+        db.Index('ix_operations_wallet_id_created', wallet_id, created.desc(), id.desc()),
+        db.Index('ix_operations_category_id', category_id),
+    )
 
-    def __init__(self, total, type_id, wallet_id, category_id=None):
-        self.total = total
+    def __init__(self, total, type_id, wallet_id, category_id=None, change_balance=True):
+        self.total = Money.of(total)
         self.type_id = type_id
         self.category_id = category_id
         self.wallet_id = wallet_id
 
-        wallet = Wallet.query.get(wallet_id)
-        wallet.change_balance(type_id, total)
+        # Callers creating several operations at once apply the deltas themselves
+        if change_balance:
+            Wallet.apply_deltas({wallet_id: self.balance_delta})
+
+    @property
+    def balance_delta(self):
+        return Wallet.balance_delta(self.type_id, self.total)
 
     def __repr__(self):
         return f'<Operation id: {self.id}, wallet_id: {self.wallet_id}, category: {self.category_id}, total: {self.total}>'
 
+    archived = False
+
+
+class ArchivedOperation(db.Model):
+    # Operations older than ARCHIVE_AFTER_DAYS, moved out of operations by
+    # the archive-operations command so the hot table and its indexes stay
+    # small. Same columns and ids, read-only. Their totals stay in
+    # operation_summaries, balances and reports don't change when they move
+    __tablename__ = 'operations_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total = db.Column(MoneyType, default=Money('0.00'))
+    type_id = db.Column(db.Integer, db.ForeignKey('types.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='SET NULL'))
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id', onupdate='CASCADE', ondelete='CASCADE'))
+    filename = db.Column(db.String(255))
+    description = db.Column(db.String(150))
+    created = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_operations_archive_wallet_id_created', wallet_id, created.desc(), id.desc()),
+    )
+
+    wallet = db.relationship('Wallet')
+    category = db.relationship('Category')
+
+    archived = True
+
+    @classmethod
+    def archive(cls, before, batch_size=1000, max_batches=None):
+        # Moves operations created before `before` here, oldest ids first,
+        # each batch in its own transaction. An interrupted run loses
+        # nothing and the next one carries on where it stopped. Returns the
+        # number of operations moved
+        columns = [column.name for column in Operation.__table__.columns]
+        moved = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            rows = db.session.query(Operation.id, Operation.created, Wallet.user_id) \
+                .join(Wallet, Operation.wallet_id == Wallet.id) \
+                .filter(Operation.created < before) \
+                .order_by(Operation.id) \
+                .limit(batch_size) \
+                .with_for_update(skip_locked=True, of=Operation) \
+                .all()
+            if not rows:
+                break
+
+            ids = [id for id, _, _ in rows]
+            source = db.select([Operation.__table__.c[name] for name in columns]).where(Operation.id.in_(ids))
+            db.session.execute(cls.__table__.insert().from_select(columns, source))
+            db.session.execute(Operation.__table__.delete().where(Operation.id.in_(ids)))
+
+            # Read paths look in the archive only back from archived_until
+            latest = {}
+            for _, created, user_id in rows:
+                latest[user_id] = max(created, latest.get(user_id, created))
+            users = User.__table__
+            db.session.execute(
+                users.update()
+                    .where(users.c.id == db.bindparam('user'))
+                    .where(db.or_(users.c.archived_until.is_(None), users.c.archived_until < db.bindparam('until')))
+                    .values(archived_until=db.bindparam('until')),
+                [{'user': user_id, 'until': created} for user_id, created in latest.items()],
+            )
+            User.touch_all(list(latest))
+            db.session.commit()
+
+            moved += len(ids)
+            batches += 1
+        return moved
+
+    def __repr__(self):
+        return f'<ArchivedOperation id: {self.id}, wallet_id: {self.wallet_id}, total: {self.total}>'
+
 
 
 class Category(db.Model):
@@ -128,7 +491,11 @@ class Category(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'))
     operations = db.relationship('Operation', backref='category', lazy=True)
 
-    created = db.Column(db.DateTime, default=datetime.now())
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_categories_user_id_type_id', user_id, type_id),
+    )
 
     def __repr__(self):
         return f'<Category id: {self.id}, name: {self.name}, user_id: {self.user_id}>'
@@ -146,5 +513,723 @@ class Type(db.Model):
     def __repr__(self):
         return f'<Type id: {self.id}, name: {self.name}>'
 
+
+class TypeCache:
+    # Process-wide copy of the types table and of each user's transfer
+    # categories, both read on every operation but almost never written
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = None
+        self.ids = None
+        self.transfer_categories = {}
+
+    def warm(self):
+        rows = db.session.query(Type.id, Type.name).order_by(Type.id).all()
+        with self.lock:
+            self.names = dict(rows)
+            self.ids = {name: id for id, name in rows}
+
+    def invalidate(self):
+        with self.lock:
+            self.names = None
+            self.ids = None
+            self.transfer_categories = {}
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            self.transfer_categories.pop(user_id, None)
+
+    def name(self, type_id):
+        if self.names is None:
+            self.warm()
+        return self.names.get(type_id)
+
+    def id(self, name):
+        if self.ids is None:
+            self.warm()
+        return self.ids.get(name)
+
+    def choices(self):
+        if self.names is None:
+            self.warm()
+        return list(self.names.items())
+
+    def transfer_category(self, user_id, type_id):
+        # The user's 'transfer' category of this type, created on first use
+        # and committed by the caller. The remembered id is checked with a
+        # primary key lookup before use: another worker may have deleted or
+        # renamed the category, or the transaction that created it may
+        # have been rolled back
+        category_id = self.transfer_categories.get(user_id, {}).get(type_id)
+        if category_id is not None:
+            with db.session.no_autoflush:
+                current = db.session.query(Category.id) \
+                    .filter(
+                        Category.id == category_id,
+                        Category.user_id == user_id,
+                        Category.type_id == type_id,
+                        Category.name == 'transfer',
+                    ) \
+                    .scalar()
+            if current is not None:
+                return category_id
+
+        categories = dict(
+            db.session.query(Category.type_id, Category.id)
+                .filter(Category.user_id == user_id, Category.name == 'transfer')
+        )
+        missing = [id for id in (self.id('income'), self.id('expense')) if id not in categories]
+        if missing:
+            new_categories = [Category(name='transfer', type_id=id, user_id=user_id) for id in missing]
+            db.session.add_all(new_categories)
+            db.session.flush()
+            categories.update((c.type_id, c.id) for c in new_categories)
+        with self.lock:
+            self.transfer_categories[user_id] = categories
+        return categories[type_id]
+
+
+types = TypeCache()
+
+
+@event.listens_for(Type, 'after_insert')
+@event.listens_for(Type, 'after_update')
+@event.listens_for(Type, 'after_delete')
+def invalidate_types(mapper, connection, target):
+    types.invalidate()
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def invalidate_transfer_categories(mapper, connection, target):
+    types.invalidate_user(target.user_id)
+
+
+class OperationSummary(db.Model):
+    # Monthly rollup of operations, maintained on every flush (see track_operation_summaries)
+    __tablename__ = 'operation_summaries'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
+    type_id = db.Column(db.Integer, db.ForeignKey('types.id'), nullable=False)
+    month = db.Column(db.Date, nullable=False)
+
+    total = db.Column(MoneyType, default=Money('0.00'), nullable=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'wallet_id', 'category_id', 'type_id', 'month'),
+        # The constraint above lets uncategorized (NULL) buckets repeat, this
+        # one doesn't. The grouping makes it a functional key part on MySQL
+        db.Index(
+            'uq_operation_summaries_bucket',
+            user_id, wallet_id, Grouping(db.func.coalesce(category_id, db.literal_column('0'))), type_id, month,
+            unique=True,
+        ),
+    )
+
+    @staticmethod
+    def month_of(created):
+        return created.date().replace(day=1)
+
+    @classmethod
+    def apply(cls, session, deltas):
+        # deltas: {(user_id, wallet_id, category_id, type_id, month): [total, count]}.
+        # Each bucket gets one atomic total = total + :total, count = count + :count,
+        # inserted when it doesn't exist yet, in key order so concurrent
+        # writers to the same buckets can't deadlock. Like Wallet.apply_deltas
+        # nothing is read back, concurrent updates can't get lost
+        deltas = {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+        if not deltas:
+            return
+        table = cls.__table__
+        rows = [
+            {
+                'user_id': user_id,
+                'wallet_id': wallet_id,
+                'category_id': category_id,
+                'type_id': type_id,
+                'month': month,
+                'total': Decimal(total),
+                'count': count,
+            }
+            for (user_id, wallet_id, category_id, type_id, month), (total, count)
+            in sorted(deltas.items(), key=lambda item: tuple(-1 if part is None else part for part in item[0]))
+        ]
+
+        dialect = db.engine.dialect.name
+        with session.no_autoflush:
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+                upsert = insert(table)
+                session.execute(upsert.on_conflict_do_update(
+                    # Same expressions as uq_operation_summaries_bucket
+                    index_elements=[
+                        table.c.user_id,
+                        table.c.wallet_id,
+                        db.func.coalesce(table.c.category_id, db.literal_column('0')),
+                        table.c.type_id,
+                        table.c.month,
+                    ],
+                    set_={'total': table.c.total + upsert.excluded.total, 'count': table.c.count + upsert.excluded.count},
+                ), rows)
+            elif dialect == 'mysql':
+                from sqlalchemy.dialects.mysql import insert
+                upsert = insert(table)
+                session.execute(upsert.on_duplicate_key_update(
+                    total=table.c.total + upsert.inserted.total,
+                    count=table.c.count + upsert.inserted.count,
+                ), rows)
+            else:
+                # SQLite: the UPDATE takes the database write lock, no other
+                # writer can insert the bucket between it and the INSERT
+                missing = []
+                for row in rows:
+                    category = table.c.category_id.is_(None) if row['category_id'] is None \
+                        else table.c.category_id == row['category_id']
+                    result = session.execute(
+                        table.update()
+                            .where(table.c.user_id == row['user_id'])
+                            .where(table.c.wallet_id == row['wallet_id'])
+                            .where(category)
+                            .where(table.c.type_id == row['type_id'])
+                            .where(table.c.month == row['month'])
+                            .values(total=table.c.total + row['total'], count=table.c.count + row['count'])
+                    )
+                    if result.rowcount == 0:
+                        missing.append(row)
+                if missing:
+                    session.execute(table.insert(), missing)
+
+            # Nothing left in these buckets
+            if any(count < 0 for _, count in deltas.values()):
+                session.execute(
+                    table.delete()
+                        .where(table.c.user_id.in_({key[0] for key in deltas}))
+                        .where(table.c.wallet_id.in_({key[1] for key in deltas}))
+                        .where(table.c.count <= 0)
+                )
+
+        # Loaded rows are stale now, reload them on next access
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, cls) and obj not in session.deleted:
+                session.expire(obj)
+
+    @classmethod
+    def rebuild(cls, user_id=None, dry_run=False):
+        # Recompute the rollup from operations, archived ones included; returns
+        # keys whose stored values were wrong
+        expected = {}
+        for model in (Operation, ArchivedOperation):
+            year = db.extract('year', model.created)
+            month = db.extract('month', model.created)
+            rows = db.session.query(
+                    Wallet.user_id,
+                    model.wallet_id,
+                    model.category_id,
+                    model.type_id,
+                    year,
+                    month,
+                    db.func.sum(model.total),
+                    db.func.count(model.id),
+                ) \
+                .join(Wallet, model.wallet_id == Wallet.id)
+            if user_id is not None:
+                rows = rows.filter(Wallet.user_id == user_id)
+            rows = rows.group_by(
+                Wallet.user_id, model.wallet_id, model.category_id, model.type_id, year, month
+            )
+
+            for user, wallet, category, op_type, y, m, total, count in rows:
+                key = (user, wallet, category, op_type, datetime(int(y), int(m), 1).date())
+                previous_total, previous_count = expected.get(key, (Decimal('0.00'), 0))
+                expected[key] = (previous_total + Decimal(total or 0), previous_count + count)
+
+        stored = cls.query
+        if user_id is not None:
+            stored = stored.filter(cls.user_id == user_id)
+        stored = {
+            (s.user_id, s.wallet_id, s.category_id, s.type_id, s.month): (Decimal(s.total), s.count)
+            for s in stored
+        }
+
+        mismatched = sorted(
+            (key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key)),
+            key=str,
+        )
+
+        if not dry_run:
+            stored_rows = cls.query
+            if user_id is not None:
+                stored_rows = stored_rows.filter(cls.user_id == user_id)
+            stored_rows.delete(synchronize_session=False)
+            db.session.bulk_insert_mappings(cls, [
+                {
+                    'user_id': key[0],
+                    'wallet_id': key[1],
+                    'category_id': key[2],
+                    'type_id': key[3],
+                    'month': key[4],
+                    'total': total,
+                    'count': count,
+                }
+                for key, (total, count) in expected.items()
+            ])
+            # Users whose reports change see a new data version
+            if mismatched:
+                User.touch_all({key[0] for key in mismatched})
+            db.session.commit()
+
+        return mismatched
+
+    def __repr__(self):
+        return f'<OperationSummary user_id: {self.user_id}, wallet_id: {self.wallet_id}, month: {self.month}, total: {self.total}>'
+
+
+class LedgerEntry(db.Model):
+    # Append-only record of every change of wallets.balance: opening balances,
+    # operation and transfer deltas and manual adjustments. created is when
+    # the balance changed, not the date of the operation
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (
+        db.Index('ix_ledger_entries_wallet_id_created', 'wallet_id', 'created'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    @classmethod
+    def since_snapshot(cls, until=None):
+        # Subquery (wallet_id, balance): latest snapshot of each wallet plus
+        # the sum of its entries recorded after it (and before `until`)
+        snapshot = BalanceSnapshot.latest()
+        entries = db.session.query(cls.wallet_id, db.func.sum(cls.amount).label('amount')) \
+            .outerjoin(snapshot, snapshot.c.wallet_id == cls.wallet_id) \
+            .filter(db.or_(snapshot.c.taken_at.is_(None), cls.created >= snapshot.c.taken_at))
+        if until is not None:
+            entries = entries.filter(cls.created < until)
+        entries = entries.group_by(cls.wallet_id).subquery()
+
+        return db.session.query(
+                Wallet.id.label('wallet_id'),
+                # Integer addition of cents, read back as Money
+                db.type_coerce(
+                    db.func.coalesce(snapshot.c.balance, 0) + db.func.coalesce(entries.c.amount, 0), MoneyType
+                ).label('balance'),
+                entries.c.amount,
+            ) \
+            .outerjoin(snapshot, snapshot.c.wallet_id == Wallet.id) \
+            .outerjoin(entries, entries.c.wallet_id == Wallet.id) \
+            .subquery()
+
+    @classmethod
+    def reconcile(cls, wallet_id=None):
+        # [(wallet_id, wallets.balance, ledger balance)] for every wallet whose
+        # balance doesn't match the ledger, in one statement
+        ledger = cls.since_snapshot()
+        rows = db.session.query(Wallet.id, Wallet.balance, ledger.c.balance) \
+            .join(ledger, ledger.c.wallet_id == Wallet.id) \
+            .order_by(Wallet.id)
+        if wallet_id is not None:
+            rows = rows.filter(Wallet.id == wallet_id)
+
+        mismatched = []
+        for id, balance, expected in rows.yield_per(1000):
+            balance, expected = Decimal(balance or 0), Decimal(expected or 0)
+            if balance.quantize(Decimal('0.01')) != expected.quantize(Decimal('0.01')):
+                mismatched.append((id, balance, expected))
+        return mismatched
+
+    def __repr__(self):
+        return f'<LedgerEntry wallet_id: {self.wallet_id}, amount: {self.amount}, reason: {self.reason}>'
+
+
+class BalanceSnapshot(db.Model):
+    # Wallet balance summed from the ledger up to taken_at, so balance_at()
+    # and reconcile() only add up the entries after the latest snapshot
+    __tablename__ = 'balance_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('wallet_id', 'taken_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    balance = db.Column(MoneyType, nullable=False)
+
+    @classmethod
+    def latest(cls):
+        # Subquery (wallet_id, taken_at, balance) of each wallet's latest snapshot
+        latest = db.session.query(cls.wallet_id, db.func.max(cls.taken_at).label('taken_at')) \
+            .group_by(cls.wallet_id) \
+            .subquery()
+        return db.session.query(cls.wallet_id, cls.taken_at, cls.balance) \
+            .join(latest, db.and_(cls.wallet_id == latest.c.wallet_id, cls.taken_at == latest.c.taken_at)) \
+            .subquery()
+
+    @classmethod
+    def take(cls, taken_at):
+        # A new snapshot for every wallet with ledger entries since its latest
+        # one. taken_at should lag behind now: an entry of a transaction that
+        # is still open is created before it commits and would be missed
+        ledger = LedgerEntry.since_snapshot(until=taken_at)
+        snapshots = [
+            {'wallet_id': wallet_id, 'taken_at': taken_at, 'balance': balance}
+            for wallet_id, balance in db.session.query(ledger.c.wallet_id, ledger.c.balance)
+                .filter(ledger.c.amount.isnot(None))
+        ]
+        db.session.bulk_insert_mappings(cls, snapshots)
+        db.session.commit()
+        return len(snapshots)
+
+    def __repr__(self):
+        return f'<BalanceSnapshot wallet_id: {self.wallet_id}, taken_at: {self.taken_at}, balance: {self.balance}>'
+
+
+class RecurringOperation(db.Model):
+    # Definition of an operation repeated every `interval` periods from
+    # `starts`. next_run is the next occurrence still to be created, the
+    # scheduler tick (run_due) turns every occurrence up to now into an
+    # operation, including the ones missed while it wasn't running
+    __tablename__ = 'recurring_operations'
+    __table_args__ = (
+        # The due query: active definitions with next_run up to now
+        db.Index('ix_recurring_operations_active_next_run', 'active', 'next_run'),
+        db.Index('ix_recurring_operations_user_id', 'user_id'),
+    )
+
+    PERIODS = ('daily', 'weekly', 'monthly', 'yearly')
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
+    type_id = db.Column(db.Integer, db.ForeignKey('types.id'), nullable=False)
+    total = db.Column(MoneyType, nullable=False)
+    description = db.Column(db.String(150))
+
+    period = db.Column(db.String(10), nullable=False, default='monthly')
+    interval = db.Column(db.Integer, nullable=False, default=1)
+    starts = db.Column(db.DateTime, nullable=False)
+    ends = db.Column(db.DateTime)
+
+    # Occurrences created so far, next_run is always occurrence(runs)
+    runs = db.Column(db.Integer, nullable=False, default=0)
+    next_run = db.Column(db.DateTime, nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    wallet = db.relationship('Wallet')
+    category = db.relationship('Category')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.runs = 0
+        self.next_run = self.starts
+
+    def occurrence(self, n):
+        # n-th occurrence counted from starts. Months and years keep the
+        # starting day, clamped to the length of shorter months
+        steps = n * (self.interval or 1)
+        if self.period == 'daily':
+            return self.starts + timedelta(days=steps)
+        if self.period == 'weekly':
+            return self.starts + timedelta(weeks=steps)
+
+        months = steps * 12 if self.period == 'yearly' else steps
+        month = self.starts.month - 1 + months
+        year, month = self.starts.year + month // 12, month % 12 + 1
+        day = min(self.starts.day, calendar.monthrange(year, month)[1])
+        return self.starts.replace(year=year, month=month, day=day)
+
+    def advance(self):
+        self.runs += 1
+        self.next_run = self.occurrence(self.runs)
+        if self.ends is not None and self.next_run > self.ends:
+            self.active = False
+
+    @classmethod
+    def run_due(cls, now=None, batch_size=500, max_catch_up=400, user_id=None):
+        # Creates every due occurrence and returns how many. Definitions are
+        # taken batch_size at a time; each batch is one transaction with one
+        # executemany insert and one balance and rollup update per wallet.
+        # A definition is caught up by at most max_catch_up occurrences per
+        # batch, the rest are due again in the next one
+        now = now or datetime.now()
+        created = 0
+        while True:
+            due = cls.query.filter(cls.active == db.true(), cls.next_run <= now)
+            if user_id is not None:
+                due = due.filter(cls.user_id == user_id)
+            due = due \
+                .order_by(cls.next_run, cls.id) \
+                .limit(batch_size) \
+                .with_for_update(skip_locked=True) \
+                .all()
+            if not due:
+                return created
+
+            batch = OperationBatch(chunk_size=batch_size)
+            for recurring in due:
+                for _ in range(max_catch_up):
+                    if not recurring.active or recurring.next_run > now:
+                        break
+                    batch.add(
+                        user_id=recurring.user_id,
+                        wallet_id=recurring.wallet_id,
+                        type_id=recurring.type_id,
+                        category_id=recurring.category_id,
+                        total=recurring.total,
+                        description=recurring.description,
+                        created=recurring.next_run,
+                    )
+                    recurring.advance()
+
+            # next_run moved for every due schedule, not only those that created operations
+            created += batch.commit(touch={recurring.user_id for recurring in due})
+
+    def __repr__(self):
+        return f'<RecurringOperation id: {self.id}, wallet_id: {self.wallet_id}, period: {self.period}, next_run: {self.next_run}>'
+
+
+class IdempotencyKey(db.Model):
+    # Stored response of a POST made with an Idempotency-Key header, replayed on retries
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+
+    # Empty while the first request is still running
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text)
+
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    @classmethod
+    def purge(cls, before):
+        # Deletes keys created before `before`, returns how many
+        count = cls.query.filter(cls.created < before).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def __repr__(self):
+        return f'<IdempotencyKey user_id: {self.user_id}, key: {self.key}, status_code: {self.status_code}>'
+
+
+class OperationBatch:
+    # Collects many operations, inserts them with executemany and applies
+    # one balance delta per wallet and one rollup delta per bucket at the end
+
+    def __init__(self, user_id=None, chunk_size=1000):
+        self.user_id = user_id
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.balance_deltas = {}
+        self.summary_deltas = {}
+        self.count = 0
+
+    def add(self, wallet_id, type_id, total, category_id=None, description=None, created=None, user_id=None):
+        total = Money.of(total)
+        created = created or datetime.now()
+        user_id = user_id or self.user_id
+
+        self.pending.append({
+            'wallet_id': wallet_id,
+            'type_id': type_id,
+            'category_id': category_id,
+            'total': total,
+            'description': description,
+            'created': created,
+        })
+
+        signed = total if types.name(type_id) == 'income' else -total
+        self.balance_deltas[wallet_id] = self.balance_deltas.get(wallet_id, Decimal('0.00')) + signed
+
+        key = (user_id, wallet_id, category_id, type_id, OperationSummary.month_of(created))
+        delta = self.summary_deltas.setdefault(key, [Decimal('0.00'), 0])
+        delta[0] += total
+        delta[1] += 1
+
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            # NULLs are rendered so rows with and without a category or
+            # description stay in one executemany instead of being split up
+            db.session.bulk_insert_mappings(Operation, self.pending, render_nulls=True)
+            self.count += len(self.pending)
+            self.pending = []
+
+    def commit(self, touch=()):
+        # Bumps the data version of every user the batch wrote for (and of
+        # the ids in touch), in the same transaction, so cached pages and
+        # ETags don't outlive it
+        self.flush()
+        Wallet.apply_deltas(self.balance_deltas)
+        OperationSummary.apply(db.session, self.summary_deltas)
+        user_ids = {key[0] for key in self.summary_deltas} | set(touch)
+        if user_ids:
+            User.touch_all(user_ids)
+        db.session.commit()
+
+        self.balance_deltas = {}
+        self.summary_deltas = {}
+        return self.count
+
+
+# Keep operation_summaries in step with every inserted, edited or deleted operation
+@event.listens_for(db.session, 'before_flush')
+def track_operation_summaries(session, flush_context, instances):
+    deltas = {}
+    wallet_users = {}
+
+    def user_of(wallet_id):
+        if wallet_id not in wallet_users:
+            with session.no_autoflush:
+                wallet_users[wallet_id] = session.query(Wallet.user_id).filter(Wallet.id == wallet_id).scalar()
+        return wallet_users[wallet_id]
+
+    def add(wallet_id, category_id, type_id, created, total, count):
+        if wallet_id is None or type_id is None or total is None:
+            return
+        key = (user_of(wallet_id), wallet_id, category_id, type_id, OperationSummary.month_of(created))
+        delta = deltas.setdefault(key, [Decimal('0.00'), 0])
+        delta[0] += Decimal(total)
+        delta[1] += count
+
+    def previous(state, name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(state.object, name)
+
+    for obj in session.new:
+        if isinstance(obj, Operation):
+            if obj.created is None:
+                obj.created = datetime.now()
+            add(obj.wallet_id, obj.category_id, obj.type_id, obj.created, obj.total, 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Operation) and session.is_modified(obj):
+            state = inspect(obj)
+            fields = ('wallet_id', 'category_id', 'type_id', 'created', 'total')
+            if not any(state.attrs[name].history.has_changes() for name in fields):
+                continue
+            old = [previous(state, name) for name in fields]
+            add(*old[:4], -Decimal(old[4] or 0), -1)
+            add(obj.wallet_id, obj.category_id, obj.type_id, obj.created, obj.total, 1)
+
+    deleted_categories = []
+    for obj in session.deleted:
+        if isinstance(obj, Operation):
+            state = inspect(obj)
+            old = [previous(state, name) for name in ('wallet_id', 'category_id', 'type_id', 'created', 'total')]
+            add(*old[:4], -Decimal(old[4] or 0), -1)
+        elif isinstance(obj, Wallet):
+            # Wallet's operations lose their wallet, so does its rollup
+            with session.no_autoflush:
+                for summary in OperationSummary.query.filter(OperationSummary.wallet_id == obj.id):
+                    session.delete(summary)
+        elif isinstance(obj, Category):
+            deleted_categories.append(obj.id)
+
+    # Operations of a deleted category become uncategorized
+    if deleted_categories:
+        with session.no_autoflush:
+            for model in (RecurringOperation, ArchivedOperation):
+                model.query \
+                    .filter(model.category_id.in_(deleted_categories)) \
+                    .update({model.category_id: None}, synchronize_session=False)
+            moved = OperationSummary.query.filter(OperationSummary.category_id.in_(deleted_categories)).all()
+        for summary in moved:
+            key = (summary.user_id, summary.wallet_id, None, summary.type_id, summary.month)
+            delta = deltas.setdefault(key, [Decimal('0.00'), 0])
+            delta[0] += summary.total
+            delta[1] += summary.count
+            session.delete(summary)
+
+    if deltas:
+        OperationSummary.apply(session, deltas)
+
+
+# Balance changes made through the ORM (a wallet's opening balance, EditWallet
+# overwriting it) are recorded in the ledger like the deltas of apply_deltas
+@event.listens_for(Wallet, 'after_insert')
+def record_opening_balance(mapper, connection, target):
+    if target.balance:
+        connection.execute(LedgerEntry.__table__.insert().values(
+            wallet_id=target.id,
+            amount=target.balance,
+            reason='opening',
+            created=datetime.now(),
+        ))
+
+
+@event.listens_for(db.session, 'before_flush')
+def track_balance_adjustments(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, Wallet) and inspect(obj).attrs.balance.history.has_changes():
+            history = inspect(obj).attrs.balance.history
+            if history.deleted:
+                old = history.deleted[0]
+            else:
+                # Expired by apply_deltas before being overwritten
+                with session.no_autoflush:
+                    old = session.query(Wallet.balance).filter(Wallet.id == obj.id).scalar()
+            delta = Decimal(obj.balance or 0) - Decimal(old or 0)
+            if delta:
+                session.add(LedgerEntry(wallet_id=obj.id, amount=delta, reason='adjustment'))
+
+    deleted_wallets = [obj.id for obj in session.deleted if isinstance(obj, Wallet)]
+    if deleted_wallets:
+        # SQLite may hand a deleted wallet's id to the next one, its history
+        # and schedule mustn't carry over
+        with session.no_autoflush:
+            for model in (LedgerEntry, BalanceSnapshot, RecurringOperation, ArchivedOperation):
+                session.query(model) \
+                    .filter(model.wallet_id.in_(deleted_wallets)) \
+                    .delete(synchronize_session=False)
+
+
+@event.listens_for(db.session, 'before_flush')
+def track_identity_changes(session, flush_context, instances):
+    # Users whose cached identity goes out of date with this transaction,
+    # forgotten once it commits so a concurrent request can't cache the
+    # old state again in between
+    changed = session.info.setdefault('identities_changed', set())
+    for obj in session.new:
+        if isinstance(obj, Wallet):
+            changed.add(obj.user_id)
+    for obj in session.deleted:
+        if isinstance(obj, Wallet):
+            changed.add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and any(inspect(obj).attrs[name].history.has_changes() for name in User.IDENTITY_COLUMNS):
+            changed.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def forget_changed_identities(session):
+    changed = session.info.pop('identities_changed', None)
+    if changed:
+        User.forget_identities(changed)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_identity_changes(session, previous_transaction):
+    session.info.pop('identities_changed', None)
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
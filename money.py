@@ -0,0 +1,50 @@
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import types
+
+
+CENT = Decimal('0.01')
+
+
+class Money(Decimal):
+    # An amount with exactly two decimal places. It is a Decimal, so forms,
+    # templates and arithmetic keep working unchanged, and it converts to
+    # and from the integer cents the database stores
+
+    __slots__ = ()
+
+    # Largest amount a BIGINT of cents holds, set below the class
+    MAX = None
+
+    @classmethod
+    def of(cls, value):
+        # Decimal, str, int (whole units) or Money, rounded half up to a cent
+        if isinstance(value, Money):
+            return value
+        return cls(Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP))
+
+    @classmethod
+    def from_cents(cls, cents):
+        return cls(Decimal(int(cents)).scaleb(-2))
+
+    @property
+    def cents(self):
+        return int(self.scaleb(2))
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+
+Money.MAX = Money.from_cents(2 ** 63 - 1)
+
+
+class MoneyType(types.TypeDecorator):
+    # Money column: a BIGINT of cents in the database, so SUM() and
+    # comparisons are integer operations. Parameters are amounts in units
+    # (Decimal, str, int), results come back as Money
+    impl = types.BigInteger
+
+    def process_bind_param(self, value, dialect):
+        return Money.of(value).cents if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return Money.from_cents(value) if value is not None else None
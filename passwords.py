@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from passlib.context import CryptContext
+import threading
+
+
+class PasswordsBusy(RuntimeError):
+    pass
+
+
+class PasswordHasher:
+    # Password hashing policy from the app config (PASSWORD_SCHEMES,
+    # PASSWORD_ROUNDS). Hashes are computed by a small thread pool: the
+    # os_crypt backend releases the GIL, so threaded workers keep serving
+    # while a hash runs, and at most PASSWORD_HASH_QUEUE hashes wait per
+    # process. Past that PasswordsBusy is raised instead of queueing the
+    # login burst behind them.
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_SCHEMES', ['sha256_crypt'])
+        app.config.setdefault('PASSWORD_ROUNDS', 535000)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 4)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        self.app = app
+        self.context = create_context(app.config['PASSWORD_SCHEMES'], app.config['PASSWORD_ROUNDS'])
+        self.slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordsBusy('Too many password checks in progress')
+        try:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                    thread_name_prefix='passwords',
+                )
+            future = self.executor.submit(function, *args)
+            try:
+                return future.result(timeout=self.app.config['PASSWORD_HASH_TIMEOUT'])
+            except TimeoutError:
+                future.cancel()
+                raise PasswordsBusy('Password check timed out')
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(self.context.hash, password)
+
+    def verify(self, user, password):
+        # True when password matches. A hash made under an older policy
+        # (another scheme or other rounds) is replaced on the user, the
+        # caller commits it
+        if user is None or not user.password:
+            return False
+        valid, new_hash = self.run(self.context.verify_and_update, password, user.password)
+        if valid and new_hash:
+            user.password = new_hash
+        return valid
+
+
+def create_context(schemes, rounds):
+    # The first scheme hashes new passwords, the others are only verified
+    # and rehashed. Hashes with rounds other than PASSWORD_ROUNDS are
+    # rehashed too, so lowering the cost takes effect as well as raising it
+    default = schemes[0]
+    return CryptContext(
+        schemes=schemes,
+        default=default,
+        deprecated='auto',
+        **{
+            f'{default}__default_rounds': rounds,
+            f'{default}__min_desired_rounds': rounds,
+            f'{default}__max_desired_rounds': rounds,
+        }
+    )
@@ -0,0 +1,211 @@
+from flask import g, request, has_request_context, abort, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('wallet.sql')
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        # statement text -> executions, same SQL with different parameters shows up as a repeat
+        self.statements = {}
+
+    def n_plus_one(self, threshold):
+        return {sql: count for sql, count in self.statements.items() if count >= threshold}
+
+
+class CountingCursor:
+    # DBAPI cursor that adds the rows fetched through it to the request's
+    # stats, whoever fetches them: ORM loads, Core selects, scalar queries
+    # and rows streamed after the view returned
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.stats.rows += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SqlProfiler:
+    # Opt-in (SQL_PROFILING) per-request SQL accounting: query count, SQL time,
+    # rows and repeated statements per request, exposed as X-SQL-* response
+    # headers, one log line per request and Prometheus histograms on /metrics.
+    # Metrics are per process, recorded when the response is closed so
+    # streamed responses include the queries run while streaming.
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_PROFILING', False)
+        app.config.setdefault('SQL_SLOW_QUERY_MS', 100)
+        app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 5)
+        self.app = app
+
+        # Listeners are global, an app factory called twice must not add them twice
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def stats(self):
+        if has_request_context():
+            return g.get('sql_stats')
+
+    def before_request(self):
+        if self.app.config['SQL_PROFILING'] and request.endpoint != 'metrics':
+            g.sql_stats = RequestStats()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.stats() is not None:
+            context._profiler_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.stats()
+        started = getattr(context, '_profiler_started', None)
+        if stats is None or started is None:
+            return
+
+        elapsed = time.perf_counter() - started
+        stats.queries += 1
+        stats.seconds += elapsed
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+        if cursor.description is not None:
+            # Rows are counted as they are fetched, the result reads them
+            # through context.cursor
+            context.cursor = CountingCursor(cursor, stats)
+        elif cursor.rowcount and cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+        if elapsed * 1000 >= self.app.config['SQL_SLOW_QUERY_MS']:
+            logger.warning('Slow query %.1fms in %s: %s', elapsed * 1000, request.endpoint, statement)
+
+    def after_request(self, response):
+        stats = self.stats()
+        if stats is None:
+            return response
+
+        # Headers go out before a streamed body, they only cover the view
+        repeated = stats.n_plus_one(self.app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        response.headers['X-SQL-Queries'] = str(stats.queries)
+        response.headers['X-SQL-Time-Ms'] = f'{stats.seconds * 1000:.2f}'
+        response.headers['X-SQL-Rows'] = str(stats.rows)
+        if repeated:
+            response.headers['X-SQL-N-Plus-One'] = str(len(repeated))
+
+        method, path, endpoint = request.method, request.path, request.endpoint or 'unknown'
+        response.call_on_close(lambda: self.finish(stats, method, path, endpoint, response.status_code))
+        return response
+
+    def finish(self, stats, method, path, endpoint, status):
+        elapsed = time.perf_counter() - stats.started
+        repeated = stats.n_plus_one(self.app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+
+        logger.info(
+            '%s %s endpoint=%s status=%s queries=%d sql_ms=%.2f rows=%d total_ms=%.2f',
+            method, path, endpoint, status,
+            stats.queries, stats.seconds * 1000, stats.rows, elapsed * 1000,
+        )
+        for statement, count in repeated.items():
+            logger.warning('Possible N+1 in %s: %d executions of %s', endpoint, count, statement)
+
+        with self.lock:
+            metrics = self.metrics.get(endpoint)
+            if metrics is None:
+                metrics = self.metrics[endpoint] = {
+                    'request_seconds': Histogram(SECONDS_BUCKETS),
+                    'sql_seconds': Histogram(SECONDS_BUCKETS),
+                    'sql_queries': Histogram(QUERIES_BUCKETS),
+                    'sql_rows': 0,
+                    'n_plus_one': 0,
+                }
+            metrics['request_seconds'].observe(elapsed)
+            metrics['sql_seconds'].observe(stats.seconds)
+            metrics['sql_queries'].observe(stats.queries)
+            metrics['sql_rows'] += stats.rows
+            metrics['n_plus_one'] += len(repeated)
+
+    def metrics_view(self):
+        if not self.app.config['SQL_PROFILING']:
+            abort(404)
+
+        lines = []
+        histograms = [
+            ('wallet_request_seconds', 'request_seconds', 'Request duration in seconds'),
+            ('wallet_sql_seconds', 'sql_seconds', 'SQL time per request in seconds'),
+            ('wallet_sql_queries', 'sql_queries', 'SQL statements per request'),
+        ]
+        with self.lock:
+            for name, key, help in histograms:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} histogram')
+                for endpoint, metrics in sorted(self.metrics.items()):
+                    histogram = metrics[key]
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+
+            counters = [
+                ('wallet_sql_rows_total', 'sql_rows', 'Rows fetched or changed by SQL'),
+                ('wallet_sql_n_plus_one_total', 'n_plus_one', 'Statements repeated past the N+1 threshold'),
+            ]
+            for name, key, help in counters:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} counter')
+                for endpoint, metrics in sorted(self.metrics.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {metrics[key]}')
+
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
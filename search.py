@@ -0,0 +1,212 @@
+from app import db
+from models import User, Operation, ArchivedOperation, Wallet, Category
+from sqlalchemy import event, DDL
+from sqlalchemy.orm import joinedload
+import re
+
+
+# SQLite: FTS5 table with description, category and wallet names, kept in
+# sync by triggers so ORM writes, bulk inserts and renames are all covered
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS operations_fts USING fts5(description, category, wallet)",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_insert AFTER INSERT ON operations BEGIN
+        INSERT INTO operations_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_update
+    AFTER UPDATE OF description, category_id, wallet_id ON operations BEGIN
+        DELETE FROM operations_fts WHERE rowid = old.id;
+        INSERT INTO operations_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_fts_delete AFTER DELETE ON operations BEGIN
+        DELETE FROM operations_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_fts_rename AFTER UPDATE OF name ON categories BEGIN
+        UPDATE operations_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM operations WHERE category_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS wallets_fts_rename AFTER UPDATE OF name ON wallets BEGIN
+        UPDATE operations_fts SET wallet = new.name
+        WHERE rowid IN (SELECT id FROM operations WHERE wallet_id = new.id);
+    END""",
+]
+
+SQLITE_REINDEX = [
+    "DELETE FROM operations_fts",
+    """INSERT INTO operations_fts (rowid, description, category, wallet)
+    SELECT operations.id, coalesce(operations.description, ''), coalesce(categories.name, ''), coalesce(wallets.name, '')
+    FROM operations
+    LEFT OUTER JOIN categories ON categories.id = operations.category_id
+    LEFT OUTER JOIN wallets ON wallets.id = operations.wallet_id""",
+]
+
+# Archived operations have their own FTS table. Archiving inserts them
+# here before deleting them from operations, so they stay searchable
+SQLITE_ARCHIVE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS operations_archive_fts USING fts5(description, category, wallet)",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_insert AFTER INSERT ON operations_archive BEGIN
+        INSERT INTO operations_archive_fts (rowid, description, category, wallet) VALUES (
+            new.id,
+            coalesce(new.description, ''),
+            coalesce((SELECT name FROM categories WHERE id = new.category_id), ''),
+            coalesce((SELECT name FROM wallets WHERE id = new.wallet_id), '')
+        );
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_update
+    AFTER UPDATE OF category_id ON operations_archive BEGIN
+        UPDATE operations_archive_fts
+        SET category = coalesce((SELECT name FROM categories WHERE id = new.category_id), '')
+        WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS operations_archive_fts_delete AFTER DELETE ON operations_archive BEGIN
+        DELETE FROM operations_archive_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_archive_fts_rename AFTER UPDATE OF name ON categories BEGIN
+        UPDATE operations_archive_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM operations_archive WHERE category_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS wallets_archive_fts_rename AFTER UPDATE OF name ON wallets BEGIN
+        UPDATE operations_archive_fts SET wallet = new.name
+        WHERE rowid IN (SELECT id FROM operations_archive WHERE wallet_id = new.id);
+    END""",
+]
+
+SQLITE_ARCHIVE_REINDEX = [
+    "DELETE FROM operations_archive_fts",
+    """INSERT INTO operations_archive_fts (rowid, description, category, wallet)
+    SELECT operations_archive.id, coalesce(operations_archive.description, ''),
+        coalesce(categories.name, ''), coalesce(wallets.name, '')
+    FROM operations_archive
+    LEFT OUTER JOIN categories ON categories.id = operations_archive.category_id
+    LEFT OUTER JOIN wallets ON wallets.id = operations_archive.wallet_id""",
+]
+
+# MySQL and PostgreSQL index the description natively, names are matched with LIKE
+MYSQL_INDEX = ["CREATE FULLTEXT INDEX ix_operations_description_ft ON operations (description)"]
+POSTGRES_INDEX = [
+    "CREATE INDEX ix_operations_description_ft ON operations "
+    "USING gin (to_tsvector('simple', coalesce(description, '')))"
+]
+MYSQL_ARCHIVE_INDEX = ["CREATE FULLTEXT INDEX ix_operations_archive_description_ft ON operations_archive (description)"]
+POSTGRES_ARCHIVE_INDEX = [
+    "CREATE INDEX ix_operations_archive_description_ft ON operations_archive "
+    "USING gin (to_tsvector('simple', coalesce(description, '')))"
+]
+
+FTS_TABLES = {Operation: 'operations_fts', ArchivedOperation: 'operations_archive_fts'}
+
+for table, indexes in (
+    (Operation.__table__, {'sqlite': SQLITE_INDEX, 'mysql': MYSQL_INDEX, 'postgresql': POSTGRES_INDEX}),
+    (ArchivedOperation.__table__, {
+        'sqlite': SQLITE_ARCHIVE_INDEX,
+        'mysql': MYSQL_ARCHIVE_INDEX,
+        'postgresql': POSTGRES_ARCHIVE_INDEX,
+    }),
+):
+    for dialect, statements in indexes.items():
+        for statement in statements:
+            event.listen(table, 'after_create', DDL(statement).execute_if(dialect=dialect))
+event.listen(
+    Operation.__table__,
+    'before_drop',
+    DDL('DROP TABLE IF EXISTS operations_fts').execute_if(dialect='sqlite'),
+)
+event.listen(
+    ArchivedOperation.__table__,
+    'before_drop',
+    DDL('DROP TABLE IF EXISTS operations_archive_fts').execute_if(dialect='sqlite'),
+)
+
+
+def reindex():
+    # Rebuild the SQLite FTS tables from operations and the archive (other databases index in place)
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for statement in SQLITE_INDEX + SQLITE_REINDEX + SQLITE_ARCHIVE_INDEX + SQLITE_ARCHIVE_REINDEX:
+        db.session.execute(statement)
+    db.session.commit()
+
+
+def words(text):
+    return re.findall(r'\w+', text or '')
+
+
+def search_query(model, user_id, terms, min_total=None, max_total=None):
+    # Matching rows of one table (Operation or ArchivedOperation) with their rank, best first
+    operations = db.session.query(model) \
+        .join(Wallet, model.wallet_id == Wallet.id) \
+        .filter(Wallet.user_id == user_id) \
+        .options(joinedload(model.category))
+
+    if min_total is not None:
+        operations = operations.filter(model.total >= min_total)
+    if max_total is not None:
+        operations = operations.filter(model.total <= max_total)
+
+    dialect = db.engine.dialect.name
+    rank = db.null()
+
+    if terms and dialect == 'sqlite':
+        # Every word must match, as a prefix, in any of the indexed columns
+        fts = FTS_TABLES[model]
+        query = ' '.join(f'"{term}"*' for term in terms)
+        rank = db.literal_column(f'-bm25({fts})', db.Float)
+        operations = operations \
+            .join(db.table(fts, db.column('rowid')), db.literal_column(f'{fts}.rowid') == model.id) \
+            .filter(db.text(f'{fts} MATCH :query').bindparams(query=query))
+    elif terms:
+        if dialect == 'mysql':
+            match = model.description.match(' '.join(f'+{term}*' for term in terms))
+            rank = db.type_coerce(match, db.Float)
+        elif dialect == 'postgresql':
+            document = db.func.to_tsvector('simple', db.func.coalesce(model.description, ''))
+            query = db.func.to_tsquery('simple', ' & '.join(f'{term}:*' for term in terms))
+            match = document.op('@@')(query)
+            rank = db.func.ts_rank(document, query)
+        else:
+            match = db.and_(*(model.description.ilike(f'%{term}%') for term in terms))
+
+        # Category and wallet names are short, a LIKE on the joined rows is enough
+        names = db.and_(*(
+            db.or_(Category.name.ilike(f'%{term}%'), Wallet.name.ilike(f'%{term}%'))
+            for term in terms
+        ))
+        operations = operations \
+            .outerjoin(Category, model.category_id == Category.id) \
+            .filter(db.or_(match, names))
+
+    return operations \
+        .add_columns(rank) \
+        .order_by(rank.desc(), model.created.desc(), model.id.desc())
+
+
+def search_operations(user_id, text=None, min_total=None, max_total=None, page=1, per_page=20):
+    # [(operation, rank)] best match first; rank is None without a text query.
+    # One extra row is fetched so callers can tell whether there is a next page.
+    # Archived operations are searched too once the user has any
+    terms = words(text)
+    offset = (page - 1) * per_page
+    operations = search_query(Operation, user_id, terms, min_total, max_total)
+
+    archived_until = db.session.query(User.archived_until).filter(User.id == user_id).scalar()
+    if archived_until is None:
+        return operations.offset(offset).limit(per_page + 1).all()
+
+    # Both tables up to the end of the page, merged in the same order
+    limit = offset + per_page + 1
+    archived = search_query(ArchivedOperation, user_id, terms, min_total, max_total)
+    results = sorted(
+        operations.limit(limit).all() + archived.limit(limit).all(),
+        key=lambda row: (row[1] or 0, row[0].created, row[0].id),
+        reverse=True,
+    )
+    return results[offset:limit]
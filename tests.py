@@ -1,24 +1,975 @@
-from app import app, db
+from app import create_app, db, cache, uploads, passwords
+from models import User, Wallet, Operation, ArchivedOperation, Category, Type, OperationSummary, LedgerEntry, BalanceSnapshot, RecurringOperation, IdempotencyKey, types
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from importer import import_statement, StatementError
+from search import search_operations
+from views.operations import export_csv
+import os
+import shutil
+import tempfile
+import io
+import json
 import unittest
+from unittest.mock import patch
+from passlib.hash import sha256_crypt
+from passwords import PasswordsBusy
+from sqlalchemy.exc import IntegrityError
+from money import Money
+
+
+app = create_app({
+    'TESTING': True,
+    'WTF_CSRF_ENABLED': False,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///test.db',
+    'PASSWORD_ROUNDS': 1000,
+}, cli=False)
+
+
+# Requests reuse the app context the test pushed, so the session isn't
+# removed by Flask-SQLAlchemy's app context teardown. Do it per request,
+# every request starts from an empty session as it would in a worker
+@app.teardown_request
+def remove_session(exception=None):
+    db.session.remove()
+
+
+class Tomorrow(date):
+    @classmethod
+    def today(cls):
+        return date.today() + timedelta(days=1)
 
 
 class AppTestCase(unittest.TestCase):
 
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+        self.context = app.app_context()
+        self.context.push()
         self.app = app.test_client()
         db.drop_all()
         db.create_all()
+        db.session.add_all([Type(id=1, name='income'), Type(id=2, name='expense')])
+        db.session.commit()
+        types.invalidate()
+        cache.clear()
 
     def tearDown(self):
-        pass
+        db.session.remove()
+        self.context.pop()
+
+    def create_user(self, username='tester', password='password123'):
+        self.app.post('/signup', data={
+            'email': f'{username}@example.com',
+            'username': username,
+            'password': password,
+            'confirm': password,
+        })
+        return User.query.filter_by(username=username).first()
+
+    def create_wallet(self, user, name='cash wallet', balance='0.00'):
+        wallet = Wallet(name=name, balance=Decimal(balance), user_id=user.id)
+        db.session.add(wallet)
+        db.session.commit()
+        return wallet
 
     def test_index(self):
         response = self.app.get('/', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_summary(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='100.00')
+        db.session.add_all([
+            Operation(total=Decimal('50.00'), type_id=1, wallet_id=wallet.id),
+            Operation(total=Decimal('20.50'), type_id=2, wallet_id=wallet.id),
+        ])
+        db.session.commit()
+
+        summary = user.get_summary()
+        self.assertEqual(summary.balance, Decimal('129.50'))
+        self.assertEqual(summary.income_sum, Decimal('50.00'))
+        self.assertEqual(summary.expenses_sum, Decimal('20.50'))
+
+        response = self.app.get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'129.50', response.data)
+
+    def test_operations_pagination(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        other = self.create_wallet(user, name='card wallet')
+        for i in range(25):
+            db.session.add(Operation(total=Decimal(i + 1), type_id=1, wallet_id=wallet.id))
+        db.session.add(Operation(total=Decimal('7.77'), type_id=2, wallet_id=other.id))
+        db.session.commit()
+
+        page = user.get_operations_page(per_page=20)
+        self.assertEqual(len(page.operations), 20)
+        self.assertIsNotNone(page.next_cursor)
+
+        last_page = user.get_operations_page(cursor=page.next_cursor, per_page=20)
+        self.assertEqual(len(last_page.operations), 6)
+        self.assertIsNone(last_page.next_cursor)
+        seen = {op.id for op in page.operations + last_page.operations}
+        self.assertEqual(len(seen), 26)
+
+        filtered = user.get_operations_page(wallet_id=other.id)
+        self.assertEqual([op.total for op in filtered.operations], [Decimal('7.77')])
+
+        response = self.app.get('/operations')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Next page', response.data)
+        response = self.app.get('/operations?cursor=garbage')
+        self.assertEqual(response.status_code, 400)
+
+    def test_operation_summaries(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        food = Category(name='food', type_id=2, user_id=user.id)
+        fun = Category(name='fun', type_id=2, user_id=user.id)
+        db.session.add_all([food, fun])
+        db.session.commit()
+
+        operation = Operation(total=Decimal('10.00'), type_id=2, wallet_id=wallet.id, category_id=food.id)
+        db.session.add_all([
+            operation,
+            Operation(total=Decimal('5.00'), type_id=2, wallet_id=wallet.id, category_id=food.id),
+        ])
+        db.session.commit()
+        user_id, operation_id = user.id, operation.id
+
+        self.app.post(f'/user/{user_id}/operation/edit/{operation_id}', data={
+            'total': '12.00',
+            'category': fun.id,
+        })
+        user = User.query.get(user_id)
+        report = {name: (total, count) for name, _, total, count in user.get_category_report()}
+        self.assertEqual(report, {'food': (Decimal('5.00'), 1), 'fun': (Decimal('12.00'), 1)})
+
+        self.app.post(f'/user/{user_id}/operation/delete/{operation_id}')
+        user = User.query.get(user_id)
+        self.assertEqual(user.get_summary().expenses_sum, Decimal('5.00'))
+        self.assertEqual(OperationSummary.rebuild(dry_run=True), [])
+
+        OperationSummary.query.delete()
+        db.session.commit()
+        self.assertEqual(len(OperationSummary.rebuild()), 1)
+        self.assertEqual(user.get_summary().expenses_sum, Decimal('5.00'))
+
+        response = self.app.get('/reports')
+        self.assertEqual(response.status_code, 200)
+
+    def test_atomic_summary_updates(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        db.session.add(Operation(total=Decimal('1.00'), type_id=2, wallet_id=wallet.id))
+        db.session.commit()
+        wallet_id = wallet.id
+
+        # Another worker adds to the bucket after this session loaded it
+        summary = OperationSummary.query.one()
+        self.assertEqual(summary.total, Decimal('1.00'))
+        db.session.execute(OperationSummary.__table__.update().values(
+            total=OperationSummary.__table__.c.total + Decimal('5.00'),
+            count=OperationSummary.__table__.c.count + 1,
+        ))
+        db.session.add(Operation(total=Decimal('2.00'), type_id=2, wallet_id=wallet_id))
+        db.session.commit()
+
+        # Added in place, not read, modified and written back. The
+        # uncategorized bucket stays a single row
+        summary = OperationSummary.query.one()
+        self.assertEqual((summary.total, summary.count), (Decimal('8.00'), 3))
+        duplicate = OperationSummary(user_id=summary.user_id, wallet_id=wallet_id, type_id=2, month=summary.month,
+                                     total=Decimal('1.00'), count=1)
+        db.session.add(duplicate)
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_atomic_balance_updates(self):
+        user = self.create_user()
+        source = self.create_wallet(user, balance='100.00')
+        target = self.create_wallet(user, name='card wallet', balance='10.00')
+        db.session.add_all([
+            Category(name='transfer', type_id=1, user_id=user.id),
+            Category(name='transfer', type_id=2, user_id=user.id),
+        ])
+        db.session.commit()
+        source_id, target_id = source.id, target.id
+
+        self.app.post(f'/wallet/{source_id}/transfer/create', data={'total': '30.00', 'wallet': target_id})
+        self.assertEqual(Wallet.query.get(source_id).balance, Decimal('70.00'))
+        self.assertEqual(Wallet.query.get(target_id).balance, Decimal('40.00'))
+
+        # Balance changes bump the version, so an edit form rendered before is rejected
+        stale_version = Wallet.query.get(source_id).version
+        Wallet.apply_deltas({source_id: Decimal('5.00')})
+        db.session.commit()
+        self.app.post(f'/wallet/edit/{source_id}', data={
+            'name': 'cash wallet',
+            'pay_type': 'cash',
+            'balance': '0.00',
+            'version': stale_version,
+        })
+        self.assertEqual(Wallet.query.get(source_id).balance, Decimal('75.00'))
+
+    def test_import_statement(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='10.00')
+        user_id, wallet_id = user.id, wallet.id
+
+        statement = (
+            'date,amount,description,category\n'
+            '2019-06-01,1000.00,June salary,salary\n'
+            '2019-06-02,-12.50,Lunch,food\n'
+            '2019-07-02,-7.50,Dinner,food\n'
+        )
+        response = self.app.post(f'/wallet/{wallet_id}/import', data={
+            'statement': (io.BytesIO(statement.encode()), 'statement.csv'),
+            'statement_format': 'csv',
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 302)
+
+        ofx = (
+            '<OFX><BANKTRANLIST>'
+            '<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20190703120000<TRNAMT>-5.00<NAME>food</STMTTRN>'
+            '</BANKTRANLIST></OFX>'
+        )
+        # Imports outside a request (the CLI) still bump the data version
+        version = db.session.query(User.data_version).filter(User.id == user_id).scalar()
+        self.assertEqual(import_statement(user_id, wallet_id, io.StringIO(ofx), 'ofx', chunk_size=1), 1)
+        self.assertEqual(User.query.get(user_id).data_version, version + 1)
+
+        user = User.query.get(user_id)
+        self.assertEqual(Wallet.query.get(wallet_id).balance, Decimal('985.00'))
+        self.assertEqual(Operation.query.count(), 4)
+        report = {(name, kind): (total, count) for name, kind, total, count in user.get_category_report()}
+        self.assertEqual(report[('food', 'expense')], (Decimal('25.00'), 3))
+        self.assertEqual(OperationSummary.rebuild(dry_run=True), [])
+
+        # Amounts that parse as Decimal but aren't numbers fail the whole statement
+        for amount in ('NaN', 'sNaN', 'Infinity', '-inf'):
+            statement = f'date,amount,description,category\n2019-07-05,{amount},Bad,food\n'
+            with self.assertRaisesRegex(StatementError, 'Line 2: wrong amount'):
+                import_statement(user_id, wallet_id, io.StringIO(statement), 'csv')
+        response = self.app.post(f'/wallet/{wallet_id}/import', data={
+            'statement': (io.BytesIO(b'date,amount\n2019-07-05,NaN\n'), 'statement.csv'),
+            'statement_format': 'csv',
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Operation.query.count(), 4)
+
+    def test_export_operations(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        db.session.add_all([
+            Operation(total=Decimal('3.00'), type_id=1, wallet_id=wallet.id),
+            Operation(total=Decimal('1.00'), type_id=2, wallet_id=wallet.id),
+        ])
+        db.session.commit()
+
+        response = self.app.get('/operations/export.csv')
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,created,wallet,category,type,total,description')
+        self.assertEqual(len(lines), 3)
+
+        response = self.app.get('/operations/export.jsonl')
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([row['type'] for row in rows], ['income', 'expense'])
+        self.assertEqual(self.app.get('/operations/export.xml').status_code, 404)
+
+        def slow_rows():
+            raise AssertionError('rows read before the header was sent')
+            yield
+        self.assertEqual(next(export_csv(slow_rows())), 'id,created,wallet,category,type,total,description\r\n')
+
+    def test_type_cache(self):
+        user = self.create_user()
+        source = self.create_wallet(user, balance='10.00')
+        target = self.create_wallet(user, name='card wallet')
+        user_id, source_id, target_id = user.id, source.id, target.id
+
+        # Transfer categories are created for the user on first transfer
+        self.app.post(f'/wallet/{source_id}/transfer/create', data={'total': '4.00', 'wallet': target_id})
+        transfer_categories = Category.query.filter_by(user_id=user_id, name='transfer').count()
+        self.assertEqual(transfer_categories, 2)
+        self.assertEqual(Wallet.query.get(target_id).balance, Decimal('4.00'))
+
+        # A remembered transfer category costs one primary key lookup
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(Wallet.balance_delta(types.id('expense'), Decimal('2.00')), Decimal('-2.00'))
+            income_transfer = types.transfer_category(user_id, types.id('income'))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 1)
+
+        # Deleted by another worker, whose mapper events never reach this one
+        db.session.execute(Category.__table__.delete().where(Category.id == income_transfer))
+        db.session.commit()
+        self.app.post(f'/wallet/{source_id}/transfer/create', data={'total': '1.00', 'wallet': target_id})
+        operation = Operation.query.filter_by(wallet_id=target_id).order_by(Operation.id.desc()).first()
+        self.assertEqual(Category.query.get(operation.category_id).name, 'transfer')
+
+        db.session.add(Type(id=3, name='refund'))
+        db.session.commit()
+        self.assertEqual(types.name(3), 'refund')
+
+    def test_ownership_checks(self):
+        owner = self.create_user()
+        wallet = self.create_wallet(owner, balance='10.00')
+        category = Category(name='food', type_id=2, user_id=owner.id)
+        db.session.add(category)
+        db.session.commit()
+        operation = Operation(total=Decimal('1.00'), type_id=2, wallet_id=wallet.id, category_id=category.id)
+        db.session.add(operation)
+        db.session.commit()
+        wallet_id, category_id, operation_id = wallet.id, category.id, operation.id
+
+        self.app = app.test_client()
+        intruder = self.create_user(username='intruder')
+        intruder_id = intruder.id
+
+        self.app.post(f'/wallet/delete/{wallet_id}')
+        self.app.post(f'/category/delete/{category_id}')
+        self.app.post(f'/user/{intruder_id}/operation/delete/{operation_id}')
+        self.app.post(f'/user/{intruder_id}/operation/edit/{operation_id}', data={'total': '100.00'})
+
+        self.assertIsNotNone(Wallet.query.get(wallet_id))
+        self.assertIsNotNone(Category.query.get(category_id))
+        self.assertEqual(Operation.query.get(operation_id).total, Decimal('1.00'))
+        self.assertEqual(Wallet.query.get(wallet_id).balance, Decimal('9.00'))
+
+    def query_plan(self, query):
+        compiled = query.statement.compile(db.engine)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return ' '.join(row[-1] for row in rows)
+
+    def test_hot_queries_use_indexes(self):
+        user = self.create_user()
+
+        plan = self.query_plan(user.query_operations())
+        self.assertIn('ix_wallets_user_id', plan)
+        self.assertIn('ix_operations_wallet_id_created', plan)
+
+        page = user.query_operations().filter(Operation.created < datetime.now())
+        self.assertIn('ix_operations_wallet_id_created', self.query_plan(page))
+
+        categories = Category.query.filter(Category.user_id == user.id, Category.type_id == 1)
+        self.assertIn('ix_categories_user_id_type_id', self.query_plan(categories))
+
+        by_category = Operation.query.filter(Operation.category_id == 1)
+        self.assertIn('ix_operations_category_id', self.query_plan(by_category))
+
+    def test_search(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        groceries = Category(name='groceries', type_id=2, user_id=user.id)
+        db.session.add(groceries)
+        db.session.commit()
+        coffee = Operation(total=Decimal('3.50'), type_id=2, wallet_id=wallet.id, category_id=groceries.id)
+        coffee.description = 'Morning coffee beans'
+        rent = Operation(total=Decimal('900.00'), type_id=2, wallet_id=wallet.id)
+        rent.description = 'Rent for June'
+        db.session.add_all([coffee, rent])
+        db.session.commit()
+        user_id, coffee_id, rent_id = user.id, coffee.id, rent.id
+
+        found = [operation.id for operation, rank in search_operations(user_id, 'coff')]
+        self.assertEqual(found, [coffee_id])
+        found = [operation.id for operation, rank in search_operations(user_id, 'grocer')]
+        self.assertEqual(found, [coffee_id])
+        found = [operation.id for operation, rank in search_operations(user_id, min_total=Decimal('100'))]
+        self.assertEqual(found, [rent_id])
+
+        # Index follows edits, renames and deletes
+        Operation.query.get(rent_id).description = 'Flat rent'
+        Category.query.get(groceries.id).name = 'food'
+        db.session.commit()
+        self.assertEqual([op.id for op, rank in search_operations(user_id, 'flat')], [rent_id])
+        self.assertEqual([op.id for op, rank in search_operations(user_id, 'food')], [coffee_id])
+
+        self.app.post(f'/user/{user_id}/operation/delete/{coffee_id}')
+        self.assertEqual(search_operations(user_id, 'coffee'), [])
+
+        self.assertEqual(search_operations(user_id + 1, 'flat'), [])
+        response = self.app.get('/search?q=flat+rent')
+        self.assertIn(b'900', response.data)
+
+    def test_sql_profiler(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        db.session.add(Operation(total=Decimal('1.00'), type_id=1, wallet_id=wallet.id))
+        db.session.commit()
+
+        self.assertNotIn('X-SQL-Queries', self.app.get('/dashboard').headers)
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+
+        app.config['SQL_PROFILING'] = True
+        try:
+            response = self.app.get('/dashboard')
+            self.assertGreater(int(response.headers['X-SQL-Queries']), 0)
+            self.assertGreater(int(response.headers['X-SQL-Rows']), 0)
+            self.assertNotIn('X-SQL-N-Plus-One', response.headers)
+            # Metrics are recorded once the server closes the response
+            response.close()
+
+            metrics = self.app.get('/metrics').data.decode()
+            self.assertIn('wallet_sql_queries_count{endpoint="wallets.dashboard"} 1', metrics)
+            self.assertIn('wallet_request_seconds_bucket{endpoint="wallets.dashboard",le="+Inf"} 1', metrics)
+
+            # Rows a streamed export fetches after the view returned are
+            # counted when the response is closed, Core rows included
+            for i in range(3):
+                db.session.add(Operation(total=Decimal('1.00'), type_id=1, wallet_id=wallet.id))
+            db.session.commit()
+            response = self.app.get('/operations/export.csv')
+            self.assertEqual(len(response.data.splitlines()), 5)
+            response.close()
+            metrics = self.app.get('/metrics').data.decode()
+            rows = metrics.split('wallet_sql_rows_total{endpoint="operations.export_operations"} ')[1].split()[0]
+            self.assertGreaterEqual(int(rows), 4)
+        finally:
+            app.config['SQL_PROFILING'] = False
+
+    def test_dashboard_cache(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='10.00')
+        salary = Category(name='salary', type_id=1, user_id=user.id)
+        db.session.add(salary)
+        db.session.commit()
+        user_id, wallet_id, salary_id = user.id, wallet.id, salary.id
+        db.session.remove()
+        self.app.get('/dashboard')
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.app.get('/dashboard')
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        # The user comes from the identity cache, only its data version is loaded
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('users.email', statements[0])
+        self.assertIn('users.data_version', statements[0])
+        self.assertIn(b'10.00', response.data)
+
+        self.app.post(f'/wallet/{wallet_id}/operation/create/type/1', data={
+            'total': '5.00',
+            'type_id': 1,
+            'category': salary_id,
+        })
+        self.assertIn(b'salary', self.app.get('/dashboard').data)
+
+        # A write from another process deletes nothing from this one's cache,
+        # the bumped data version alone moves the dashboard to a new key
+        statement = 'date,amount,description,category\n2019-06-01,-2.00,Lunch,lunch\n'
+        import_statement(user_id, wallet_id, io.StringIO(statement), 'csv')
+        self.assertIn(b'lunch', self.app.get('/dashboard').data)
+
+    def test_identity_cache(self):
+        user = self.create_user()
+        user_id = user.id
+        db.session.remove()
+        self.app.get('/dashboard')
+        key = User.identity_cache_key(user_id)
+        self.assertEqual(cache.get(key)['wallet_ids'], [])
+
+        response = self.app.post('/api/wallets', json={'name': 'card', 'pay_type': 'card', 'balance': '5.00'})
+        wallet_id = response.get_json()['id']
+        self.assertIsNone(cache.get(key))
+        self.app.get('/dashboard')
+        self.assertEqual(cache.get(key)['wallet_ids'], [wallet_id])
+
+        # Writes don't trust the cached list: a wallet created through another
+        # worker is found, and a wallet id that now belongs to someone else
+        # (deleted and reused) is refused
+        bob = User(email='bob@example.com', username='bob', password='x')
+        db.session.add(bob)
+        db.session.flush()
+        other = Wallet(name='other wallet', balance=Decimal('100.00'), user_id=bob.id)
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        cache.set(key, dict(cache.get(key), wallet_ids=[other_id]))
+        response = self.app.post('/api/operations/batch', json={'operations': [
+            {'wallet_id': other_id, 'type': 'expense', 'total': '99.00'},
+        ]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Wallet.query.get(other_id).balance, Decimal('100.00'))
+        response = self.app.post('/api/operations', json={'wallet_id': wallet_id, 'type': 'income', 'total': '1.00'})
+        self.assertEqual(response.status_code, 201)
+
+        self.app.get('/dashboard')
+        self.app.post(f'/wallet/delete/{wallet_id}')
+        self.assertIsNone(cache.get(key))
+
+    def test_read_replica(self):
+        user = self.create_user()
+        db.session.add(Category(name='salary', type_id=1, user_id=user.id))
+        db.session.commit()
+        # The replica is a copy of the primary that then falls behind
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copy(db.engine.url.database, replica)
+        db.session.add(Category(name='lagging', type_id=2, user_id=user.id))
+        db.session.commit()
+        db.session.remove()
+
+        uri = f'sqlite:///{replica}'
+        app.config.update(SQLALCHEMY_REPLICA_URI=uri, SQLALCHEMY_BINDS={'replica': uri})
+        try:
+            page = self.app.get('/categories').data
+            self.assertIn(b'salary', page)
+            self.assertNotIn(b'lagging', page)
+
+            # Writes go to the primary, which answers the client's reads right after
+            self.app.post('/category/create', data={'name': 'fresh', 'type_id': 2})
+            page = self.app.get('/categories').data
+            self.assertIn(b'lagging', page)
+            self.assertIn(b'fresh', page)
+            count = db.get_engine(app, bind='replica').execute("SELECT count(*) FROM categories WHERE name = 'fresh'")
+            self.assertEqual(count.scalar(), 0)
+
+            with self.app.session_transaction() as session:
+                session['primary_until'] = 0
+            self.assertNotIn(b'fresh', self.app.get('/categories').data)
+        finally:
+            app.config.update(SQLALCHEMY_REPLICA_URI=None, SQLALCHEMY_BINDS=None)
+
+    def test_conditional_get(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='10.00')
+        wallet_id = wallet.id
+        self.app.get('/dashboard')
+
+        response = self.app.get('/operations')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.app.get('/operations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.app.get('/operations?wallet=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        # Last-Modified is informational, a second write within the same
+        # second would not change it
+        response = self.app.get('/operations', headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 200)
+
+        self.app.post(f'/wallet/edit/{wallet_id}', data={
+            'name': 'renamed wallet',
+            'pay_type': 'cash',
+            'balance': '20.00',
+            'version': Wallet.query.get(wallet_id).version,
+        }, follow_redirects=True)
+        response = self.app.get('/operations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Pages default their ranges to today, the next day is a new ETag
+        etag = self.app.get('/operations').headers['ETag']
+        with patch('views.date', Tomorrow):
+            response = self.app.get('/operations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_api_batch_operations(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='100.00')
+        salary = Category(name='salary', type_id=1, user_id=user.id)
+        db.session.add(salary)
+        db.session.commit()
+        user_id, wallet_id, salary_id = user.id, wallet.id, salary.id
+
+        response = self.app.post('/api/operations/batch', json={'operations': [
+            {'wallet_id': wallet_id, 'type': 'income', 'total': '10.00', 'category_id': salary_id},
+            {'wallet_id': wallet_id + 100, 'type': 'expense', 'total': '-1'},
+        ]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['operations'][0]['index'], 1)
+        self.assertEqual(Operation.query.count(), 0)
+
+        operations = [
+            {'wallet_id': wallet_id, 'type': 'income', 'total': 10.5, 'category_id': salary_id},
+            {'wallet_id': wallet_id, 'type': 'expense', 'total': '2.25', 'description': 'coffee'},
+        ] * 50
+        headers = {'Idempotency-Key': 'batch-1'}
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.app.post('/api/operations/batch', json={'operations': operations}, headers=headers)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json(), {'created': 100})
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO operations ')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE wallets')]), 1)
+
+        # A retry is answered from the stored response without inserting again
+        response = self.app.post('/api/operations/batch', json={'operations': operations}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Operation.query.count(), 100)
+        self.assertEqual(Wallet.query.get(wallet_id).balance, Decimal('512.50'))
+        self.assertEqual(OperationSummary.rebuild(user_id=user_id, dry_run=True), [])
+
+        response = self.app.post('/api/operations/batch', json={'operations': operations[:1]}, headers=headers)
+        self.assertEqual(response.status_code, 422)
+
+        page = self.app.get('/api/operations?per_page=60').get_json()
+        self.assertEqual(len(page['operations']), 60)
+        self.assertIsNotNone(page['next_cursor'])
+        self.assertEqual(self.app.get('/api/wallets').get_json()['wallets'][0]['balance'], '512.50')
+
+        # A reservation whose worker died mid-request holds retries off for a minute, not a day
+        IdempotencyKey.query.filter_by(key='batch-1').update({'status_code': None, 'response': None, 'created': datetime.now()})
+        db.session.commit()
+        response = self.app.post('/api/operations/batch', json={'operations': operations}, headers=headers)
+        self.assertEqual(response.status_code, 409)
+        IdempotencyKey.query.filter_by(key='batch-1').update({'created': datetime.now() - timedelta(seconds=120)})
+        db.session.commit()
+        response = self.app.post('/api/operations/batch', json={'operations': operations}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(IdempotencyKey.purge(datetime.now() + timedelta(seconds=1)), 1)
+
+        self.app.get('/logout')
+        anonymous = app.test_client()
+        self.assertEqual(anonymous.get('/api/wallets').status_code, 401)
+
+    def test_api_id_types(self):
+        user = self.create_user()
+        source = self.create_wallet(user, balance='10.00')
+        target = self.create_wallet(user, name='card wallet')
+        source_id, target_id = source.id, target.id
+
+        # Only JSON integers are ids: lists and objects are a bad request, true is not wallet 1
+        for bad in ([source_id], {'id': source_id}, True):
+            response = self.app.post('/api/transfers', json={'from_wallet_id': bad, 'to_wallet_id': target_id, 'total': '1.00'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['fields'], ['from_wallet_id'])
+            response = self.app.post('/api/operations', json={'wallet_id': bad, 'type': 'income', 'total': '1.00'})
+            self.assertEqual(response.status_code, 400)
+            response = self.app.post('/api/operations/batch', json={'operations': [
+                {'wallet_id': source_id, 'type': 'income', 'total': '1.00'},
+                {'wallet_id': source_id, 'type': 'income', 'total': '1.00', 'category_id': bad},
+            ]})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()['operations'], [{'index': 1, 'fields': ['category_id']}])
+
+        response = self.app.post('/api/operations', json={'wallet_id': source_id, 'type': True, 'total': '1.00'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.app.post('/api/login', json={'username': ['x'], 'password': 'x'}).status_code, 400)
+        self.assertEqual(Operation.query.count(), 0)
+
+    def test_upload_dedup_and_thumbnails(self):
+        from PIL import Image
+
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        salary = Category(name='salary', type_id=1, user_id=user.id)
+        db.session.add(salary)
+        db.session.commit()
+        wallet_id, salary_id = wallet.id, salary.id
+
+        image = io.BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, 'PNG')
+        folder = app.config['UPLOAD_FOLDER']
+        app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        try:
+            for filename in ['receipt.png', 'other.png']:
+                self.app.post(f'/wallet/{wallet_id}/operation/create/type/1', data={
+                    'total': '5.00',
+                    'type_id': 1,
+                    'category': salary_id,
+                    'image': (io.BytesIO(image.getvalue()), filename),
+                }, content_type='multipart/form-data')
+            uploads.executor.shutdown(wait=True)
+            uploads.executor = None
+
+            names = {op.filename for op in Operation.query}
+            self.assertEqual(len(names), 1)
+            name = names.pop()
+            self.assertTrue(name.endswith('.png'))
+            self.assertEqual(sorted(os.listdir(app.config['UPLOAD_FOLDER'])), sorted([name, 'thumbs']))
+            with Image.open(uploads.path(name, thumbnail=True)) as thumbnail:
+                self.assertLessEqual(max(thumbnail.size), 100)
+            self.assertIn(b'uploads/thumbs/', self.app.get('/operations').data)
+
+            app.config['UPLOAD_MAX_SIZE'] = 1024
+            self.app.post(f'/wallet/{wallet_id}/operation/create/type/1', data={
+                'total': '5.00',
+                'type_id': 1,
+                'category': salary_id,
+                'image': (io.BytesIO(image.getvalue()), 'large.png'),
+            }, content_type='multipart/form-data')
+            self.assertEqual(Operation.query.count(), 2)
+            self.assertEqual(len(os.listdir(app.config['UPLOAD_FOLDER'])), 2)
+        finally:
+            app.config['UPLOAD_FOLDER'] = folder
+            app.config['UPLOAD_MAX_SIZE'] = 10 * 1024 * 1024
+
+
+    def test_balance_ledger(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='100.00')
+        other = self.create_wallet(user, name='card wallet')
+        wallet_id, other_id = wallet.id, other.id
+        db.session.add(Operation(total=Decimal('30.00'), type_id=2, wallet_id=wallet_id))
+        db.session.commit()
+        before_edit = datetime.now()
+
+        self.app.post(f'/wallet/edit/{wallet_id}', data={
+            'name': 'cash wallet',
+            'pay_type': 'cash',
+            'balance': '50.00',
+            'version': Wallet.query.get(wallet_id).version,
+        })
+        self.app.post(f'/wallet/{wallet_id}/transfer/create', data={'total': '20.00', 'wallet': other_id})
+        reasons = [entry.reason for entry in LedgerEntry.query.order_by(LedgerEntry.id)]
+        self.assertEqual(reasons, ['opening', 'operation', 'adjustment', 'transfer', 'transfer'])
+        self.assertEqual(LedgerEntry.reconcile(), [])
+
+        self.assertEqual(BalanceSnapshot.take(datetime.now()), 2)
+        db.session.add(Operation(total=Decimal('5.00'), type_id=1, wallet_id=wallet_id))
+        db.session.commit()
+
+        wallet = Wallet.query.get(wallet_id)
+        self.assertEqual(wallet.balance_at(before_edit), Decimal('70.00'))
+        self.assertEqual(wallet.balance_at(datetime.now() + timedelta(seconds=2)), Decimal('35.00'))
+        self.assertEqual(Wallet.query.get(other_id).balance_at(datetime.now()), Decimal('20.00'))
+        self.assertEqual(LedgerEntry.reconcile(), [])
+
+        # A balance changed behind the ledger's back is reported
+        Wallet.query.filter(Wallet.id == other_id).update({Wallet.balance: Decimal('1.00')})
+        db.session.commit()
+        self.assertEqual([id for id, _, _ in LedgerEntry.reconcile()], [other_id])
+
+
+    def test_analytics(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        food = Category(name='food', type_id=2, user_id=user.id)
+        db.session.add(food)
+        db.session.commit()
+        for created, type_id, total in [
+            (datetime(2019, 1, 5, 10), 1, '100.00'),
+            (datetime(2019, 1, 7, 23, 59), 2, '10.50'),
+            (datetime(2019, 2, 1, 0, 0), 2, '20.00'),
+            (datetime(2019, 3, 31, 12), 2, '30.00'),
+            (datetime(2019, 4, 1, 12), 2, '99.00'),
+        ]:
+            operation = Operation(total=Decimal(total), type_id=type_id, wallet_id=wallet.id,
+                                  category_id=food.id if type_id == 2 else None)
+            operation.created = created
+            db.session.add(operation)
+        db.session.commit()
+        wallet_id, food_id = wallet.id, food.id
+
+        response = self.app.get('/api/analytics?from=2019-01-01&to=2019-03-31&bucket=month&window=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['labels'], ['2019-01', '2019-02', '2019-03'])
+        self.assertEqual(data['income'], [10000, 0, 0])
+        self.assertEqual(data['expense'], [1050, 2000, 3000])
+        self.assertEqual(data['expense_rolling'], [1050, 1525, 2500])
+        self.assertEqual(data['expense_change'], [None, 0.9048, 0.5])
+        self.assertEqual(data['expense_percentiles']['p50'], 2000)
+        self.assertEqual(data['categories'][0], {'id': food_id, 'name': 'food', 'type': 'expense', 'total': 6050, 'count': 3})
+        self.assertEqual(data['wallets'], [{'id': wallet_id, 'income': 10000, 'expense': 6050}])
+
+        data = self.app.get('/api/analytics?from=2019-01-01&to=2019-01-13&bucket=week').get_json()
+        self.assertEqual(data['labels'], ['2018-12-31', '2019-01-07'])
+        self.assertEqual(data['count'], [1, 1])
+        self.assertEqual(self.app.get('/api/analytics?bucket=year').status_code, 400)
+
+
+    def test_recurring_operations(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='1000.00')
+        rent = Category(name='rent', type_id=2, user_id=user.id)
+        db.session.add(rent)
+        db.session.commit()
+        user_id, wallet_id, rent_id = user.id, wallet.id, rent.id
+
+        db.session.add_all([
+            RecurringOperation(user_id=user_id, wallet_id=wallet_id, category_id=rent_id, type_id=2,
+                               total=Decimal('100.00'), period='monthly', starts=datetime(2019, 1, 31, 12)),
+            RecurringOperation(user_id=user_id, wallet_id=wallet_id, type_id=1, total=Decimal('10.00'),
+                               period='weekly', interval=2, starts=datetime(2019, 1, 1, 12),
+                               ends=datetime(2019, 1, 31)),
+        ])
+        db.session.commit()
+
+        # Catches up everything missed, two definitions per transaction
+        self.assertEqual(RecurringOperation.run_due(now=datetime(2019, 4, 15), batch_size=1, max_catch_up=2), 6)
+        self.assertEqual(RecurringOperation.run_due(now=datetime(2019, 4, 15)), 0)
+
+        rent_dates = [op.created.date().isoformat() for op in Operation.query.filter_by(category_id=rent_id).order_by(Operation.created)]
+        self.assertEqual(rent_dates, ['2019-01-31', '2019-02-28', '2019-03-31'])
+        self.assertEqual(Operation.query.filter_by(type_id=1).count(), 3)
+        self.assertEqual(Wallet.query.get(wallet_id).balance, Decimal('730.00'))
+        self.assertEqual(OperationSummary.rebuild(user_id=user_id, dry_run=True), [])
+        self.assertEqual(LedgerEntry.reconcile(), [])
+        self.assertEqual(RecurringOperation.query.filter_by(active=False).count(), 1)
+        self.assertEqual(User.query.get(user_id).data_version, 4)  # one bump per transaction
+
+        self.app.post(f'/wallet/{wallet_id}/recurring/create', data={
+            'total': '5.00',
+            'type_id': 2,
+            'category': rent_id,
+            'interval': 1,
+            'period': 'daily',
+            'starts': (datetime.now() - timedelta(days=2)).strftime('%Y-%m-%d'),
+        })
+        self.assertEqual(Operation.query.filter_by(total=Decimal('5.00')).count(), 3)
+        self.assertIn(b'rent', self.app.get('/recurring').data)
+
+    def test_password_rehash(self):
+        user = self.create_user()
+        self.assertTrue(user.password.startswith('$5$rounds=1000$'))
+
+        # A hash from an older, stronger policy is replaced on the next login
+        user.password = sha256_crypt.using(rounds=2000).hash('password123')
+        db.session.commit()
+        response = self.app.post('/login', data={'username': 'tester', 'password': 'password123'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(User.query.get(user.id).password.startswith('$5$rounds=1000$'))
+
+        response = self.app.post('/api/login', json={'username': 'tester', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+
+        slots = passwords.slots
+        passwords.slots = type(slots)(1)
+        passwords.slots.acquire()
+        try:
+            response = self.app.post('/api/login', json={'username': 'tester', 'password': 'password123'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertRaises(PasswordsBusy, passwords.hash, 'password123')
+        finally:
+            passwords.slots = slots
+
+    def test_archive_operations(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user)
+        salary = Category(name='salary', type_id=1, user_id=user.id)
+        db.session.add(salary)
+        db.session.commit()
+        old = datetime(2019, 3, 1, 12)
+        for created in [old + timedelta(days=n) for n in range(5)] + [datetime.now() - timedelta(minutes=n) for n in range(3)]:
+            operation = Operation(total=Decimal('10.00'), type_id=1, wallet_id=wallet.id, category_id=salary.id)
+            operation.created = created
+            db.session.add(operation)
+        db.session.commit()
+        user_id, wallet_id = user.id, wallet.id
+        report = User.query.get(user_id).get_monthly_report()
+        horizon = datetime.now() - timedelta(days=365)
+
+        # Batches commit one by one, a stopped run is picked up by the next
+        self.assertEqual(ArchivedOperation.archive(horizon, batch_size=2, max_batches=1), 2)
+        self.assertEqual(ArchivedOperation.archive(horizon, batch_size=2), 3)
+        self.assertEqual(ArchivedOperation.archive(horizon), 0)
+        self.assertEqual(Operation.query.count(), 3)
+        self.assertEqual(ArchivedOperation.query.count(), 5)
+
+        user = User.query.get(user_id)
+        self.assertEqual(user.archived_until, old + timedelta(days=4))
+        self.assertEqual(user.get_monthly_report(), report)
+        self.assertEqual(user.get_balance(), Decimal('80.00'))
+        self.assertEqual(OperationSummary.rebuild(user_id=user_id, dry_run=True), [])
+
+        # Pages run on from the hot table into the archive
+        first = user.get_operations_page(per_page=5)
+        self.assertEqual([op.archived for op in first.operations], [False] * 3 + [True] * 2)
+        second = user.get_operations_page(cursor=first.next_cursor, per_page=5)
+        self.assertEqual([op.created for op in second.operations], [old + timedelta(days=n) for n in (2, 1, 0)])
+        self.assertIsNone(second.next_cursor)
+
+        # A range that stays in the hot table doesn't read the archive
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            recent = user.get_operations_page(per_page=5, date_from=datetime.now().date() - timedelta(days=30))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(recent.operations), 3)
+        self.assertFalse(any('operations_archive' in statement for statement in statements))
+
+        # Archived operations stay searchable, merged into the same pages
+        first = search_operations(user_id, 'salary', per_page=5)
+        self.assertEqual([op.archived for op, rank in first], [False] * 3 + [True] * 3)
+        second = search_operations(user_id, 'salary', page=2, per_page=5)
+        self.assertEqual([op.created for op, rank in second], [old + timedelta(days=n) for n in (2, 1, 0)])
+
+        self.assertEqual(len(self.app.get('/operations/export.csv').data.decode().splitlines()), 9)
+        data = self.app.get('/api/analytics?from=2019-03-01&to=2019-03-31&bucket=month').get_json()
+        self.assertEqual(data['income'], [5000])
+
+        self.app.post(f'/wallet/delete/{wallet_id}')
+        self.assertEqual(ArchivedOperation.query.count(), 0)
+
+    def test_money_cents(self):
+        self.assertEqual(Money.of('10.005'), Money('10.01'))
+        self.assertEqual(Money.of('-0.125').cents, -13)
+        self.assertEqual(Money.from_cents(1050), Decimal('10.50'))
+
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='10.50')
+        user_id, wallet_id = user.id, wallet.id
+        for total in ('0.10', '0.10', '0.10'):
+            response = self.app.post('/api/operations', json={'wallet_id': wallet_id, 'type': 'expense', 'total': total})
+            self.assertEqual(response.status_code, 201)
+
+        # Stored as cents, read back as Money
+        self.assertEqual(db.session.execute('SELECT balance FROM wallets').scalar(), 1020)
+        db.session.remove()
+        balance = Wallet.query.get(wallet_id).balance
+        self.assertIsInstance(balance, Money)
+        self.assertEqual(str(balance), '10.20')
+        self.assertEqual(User.query.get(user_id).get_summary().expenses_sum, Decimal('0.30'))
+        self.assertEqual(LedgerEntry.reconcile(), [])
+
+        response = self.app.post('/api/operations', json={'wallet_id': wallet_id, 'type': 'income', 'total': '1e20'})
+        self.assertEqual(response.status_code, 422)
+
+    def test_sub_cent_amounts(self):
+        user = self.create_user()
+        wallet = self.create_wallet(user, balance='10.00')
+        food = Category(name='food', type_id=2, user_id=user.id)
+        db.session.add(food)
+        db.session.commit()
+        user_id, wallet_id, food_id = user.id, wallet.id, food.id
+
+        # Amounts are rounded before the balance and rollup deltas are taken
+        statement = 'date,amount,description,category\n' + '2019-06-01,-0.005,Gum,food\n' * 3
+        self.assertEqual(import_statement(user_id, wallet_id, io.StringIO(statement), 'csv'), 3)
+        self.assertEqual(Wallet.query.get(wallet_id).balance, Decimal('9.97'))
+
+        operation_id = Operation.query.first().id
+        response = self.app.post(f'/user/{user_id}/operation/edit/{operation_id}', data={
+            'total': '0.004', 'category': food_id, 'type_id': 2,
+        })
+        self.assertEqual(response.status_code, 302)
+        response = self.app.post(f'/wallet/{wallet_id}/operation/create/type/2', data={
+            'total': '1.005', 'category': food_id, 'type_id': 2,
+        })
+        self.assertEqual(response.status_code, 302)
+
+        db.session.remove()
+        totals = [op.total for op in Operation.query.order_by(Operation.id)]
+        balance = Wallet.query.get(wallet_id).balance
+        self.assertEqual(Decimal('10.00') - sum(totals), balance)
+        self.assertEqual(OperationSummary.rebuild(user_id=user_id, dry_run=True), [])
+        self.assertEqual(LedgerEntry.reconcile(), [])
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import url_for
+import hashlib
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger('wallet.uploads')
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadStore:
+    # Receipts are streamed to UPLOAD_FOLDER in chunks and stored as
+    # <sha256>.<ext>, so the same file uploaded twice is kept once and
+    # same-named files never overwrite each other. Image thumbnails are
+    # written to UPLOAD_FOLDER/thumbs by a worker pool after the request
+    # has returned; until one exists the original is served instead.
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('UPLOAD_MAX_SIZE', 10 * 1024 * 1024)
+        app.config.setdefault('UPLOAD_CHUNK_SIZE', 64 * 1024)
+        app.config.setdefault('THUMBNAIL_SIZE', (100, 100))
+        app.config.setdefault('THUMBNAIL_WORKERS', 2)
+        self.app = app
+        app.add_template_global(self.url, 'upload_url')
+
+    @property
+    def folder(self):
+        return self.app.config['UPLOAD_FOLDER']
+
+    def path(self, name, thumbnail=False):
+        if thumbnail:
+            return os.path.join(self.folder, 'thumbs', thumbnail_name(name))
+        return os.path.join(self.folder, name)
+
+    def save(self, file, extension):
+        # Returns the stored name. Raises UploadError past UPLOAD_MAX_SIZE,
+        # nothing is left on disk then
+        max_size = self.app.config['UPLOAD_MAX_SIZE']
+        chunk_size = self.app.config['UPLOAD_CHUNK_SIZE']
+        os.makedirs(self.folder, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, partial = tempfile.mkstemp(dir=self.folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = file.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise UploadError(f'File is larger than {max_size // (1024 * 1024)} MB')
+                    digest.update(chunk)
+                    out.write(chunk)
+
+            name = f'{digest.hexdigest()}.{extension.lower()}'
+            target = self.path(name)
+            if os.path.exists(target):
+                os.remove(partial)
+            else:
+                os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        if extension.lower() in IMAGE_EXTENSIONS and not os.path.exists(self.path(name, thumbnail=True)):
+            self.submit(name)
+        return name
+
+    def submit(self, name):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.app.config['THUMBNAIL_WORKERS'],
+                thread_name_prefix='thumbnails',
+            )
+        return self.executor.submit(self.make_thumbnail, name)
+
+    def make_thumbnail(self, name):
+        try:
+            from PIL import Image
+        except ImportError:
+            logger.warning('Pillow is not installed, no thumbnail for %s', name)
+            return None
+
+        target = self.path(name, thumbnail=True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            with Image.open(self.path(name)) as image:
+                image.thumbnail(self.app.config['THUMBNAIL_SIZE'])
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                # Written under a temporary name so a half-written thumbnail is never served
+                image.save(target + '.part', 'JPEG', quality=85, optimize=True)
+            os.replace(target + '.part', target)
+        except Exception:
+            logger.exception('Thumbnail for %s failed', name)
+            return None
+        return target
+
+    def url(self, name, thumbnail=False):
+        if thumbnail and os.path.exists(self.path(name, thumbnail=True)):
+            return url_for('static', filename=f'uploads/thumbs/{thumbnail_name(name)}')
+        return url_for('static', filename=f'uploads/{name}')
+
+
+def thumbnail_name(name):
+    return name.rsplit('.', 1)[0] + '.jpg'
@@ -0,0 +1,113 @@
+from app import cache
+from database import replica_allowed
+from models import Wallet, Operation
+from flask import g, request, session, make_response, abort, Response
+from flask_login import current_user
+from datetime import date, datetime
+from functools import wraps
+import hashlib
+
+
+# Load current user's wallet, category or operation by id, None if it belongs to someone else.
+# Ownership is part of the same indexed query (EXISTS on the wallet for operations)
+def owned(model, id):
+    query = model.query.filter(model.id == id)
+    if model is Operation:
+        query = query.filter(Operation.wallet.has(Wallet.user_id == current_user.id))
+    else:
+        query = query.filter(model.user_id == current_user.id)
+    return query.first()
+
+
+# Cached per data version, entries of older versions are never read again
+def dashboard_view_model(user):
+    key = f'dashboard:{user.id}:{user.data_version}'
+    context = cache.get(key)
+    if context is None:
+        summary = user.get_summary()
+        context = {
+            'balance': summary.balance,
+            'wallets': [
+                {'id': w.id, 'name': w.name, 'pay_type': w.pay_type, 'balance': w.balance}
+                for w in user.get_wallets()
+            ],
+            'operations': [
+                {
+                    'id': op.id,
+                    'created': op.created,
+                    'type_id': op.type_id,
+                    'total': op.total,
+                    'category_name': op.category.name if op.category else None,
+                }
+                for op in user.get_operations(limit=10)
+            ],
+            'income_sum': summary.income_sum,
+            'expenses_sum': summary.expenses_sum,
+        }
+        cache.set(key, context)
+    return context
+
+
+# Conditional GET for read-only pages: the ETag is derived from the user's
+# data version, the URL and today's date (pages default their date ranges to
+# today), so an unchanged page is answered with 304 before the view runs any
+# query or renders anything. Only the ETag is validated: Last-Modified has
+# one-second resolution and two writes within a second would look unchanged
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pending flash messages have to be rendered, never answer 304 then
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        url = hashlib.sha1(request.full_path.encode()).hexdigest()[:16]
+        etag = f'{current_user.id}-{current_user.data_version}-{date.today():%Y%m%d}-{url}'
+        last_modified = (current_user.data_updated or current_user.created).replace(microsecond=0)
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+
+    return wrapper
+
+
+# For views that only read: their queries go to the read replica when one is
+# configured, unless this client wrote something moments ago. Goes before
+# @conditional, the ETag's data version must come from the same database as the page
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if replica_allowed():
+            g.use_replica = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+OPERATIONS_PER_PAGE = 20
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Cursor for keyset pagination is "<created>_<id>" of the last row on the previous page
+def encode_cursor(cursor):
+    created, op_id = cursor
+    return f'{created.strftime(CURSOR_FORMAT)}_{op_id}'
+
+
+def decode_cursor(value):
+    try:
+        created, op_id = value.rsplit('_', 1)
+        return datetime.strptime(created, CURSOR_FORMAT), int(op_id)
+    except ValueError:
+        abort(400)
@@ -0,0 +1,75 @@
+from app import db, login_manager, passwords
+from models import User
+from forms import SignUpForm, LoginForm
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, Response
+from flask.views import MethodView
+from flask_login import login_user
+from passwords import PasswordsBusy
+
+
+bp = Blueprint('auth', __name__)
+
+
+@login_manager.user_loader
+def load_user(id):
+    return User.load_identity(int(id), ttl=current_app.config['IDENTITY_CACHE_TTL'])
+
+
+@bp.errorhandler(PasswordsBusy)
+def passwords_busy(error):
+    return Response('Too many logins at the moment, try again shortly', 503, {'Retry-After': '1'})
+
+
+@bp.route('/')
+def index():
+    return render_template('index.html')
+
+
+class SignUp(MethodView):
+
+    def get(self):
+        form = SignUpForm()
+        return render_template('signup.html', form=form)
+
+    def post(self):
+        form = SignUpForm(request.form)
+        if form.validate():
+            email = form.email.data
+            username = form.username.data
+            hashed_password = passwords.hash(form.password.data)
+
+            new_user = User(email=email, username=username, password=hashed_password)
+            db.session.add(new_user)
+            db.session.commit()
+
+            login_user(new_user)
+            flash('You successfully registered', category='success')
+
+            return redirect(url_for('auth.index'))
+   
+        return render_template('signup.html', form=form)
+
+bp.add_url_rule('/signup', view_func=SignUp.as_view('signup'))
+
+
+class Login(MethodView):
+    
+    def get(self):
+        form = LoginForm()
+        return render_template('login.html', form=form)
+
+    def post(self):
+        form = LoginForm(request.form)
+        if form.validate():
+            user = User.query.filter_by(username=form.username.data).first()
+            if passwords.verify(user, form.password.data):
+                # verify may have rehashed the password to the current policy
+                db.session.commit()
+                login_user(user)
+                flash('You successfully logged in', category='success')
+                return redirect(url_for('auth.index'))
+
+            flash('Username or Password is not correct', category='danger')
+            return render_template('login.html', form=form)
+
+bp.add_url_rule('/login', view_func=Login.as_view('login'))
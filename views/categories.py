@@ -0,0 +1,88 @@
+from app import db
+from models import Category, types
+from forms import CategoryForm
+from views import owned, conditional, read_only
+from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask_login import current_user, login_required
+
+
+bp = Blueprint('categories', __name__)
+
+
+@bp.route('/category/create', methods=['GET', 'POST'])
+@login_required
+def create_category():
+    form = CategoryForm(request.form)
+    
+    # define choices for operation types
+    form.type_id.choices = types.choices()
+
+    if request.method == 'POST' and form.validate():
+        new_category = Category(
+            name=form.name.data,
+            type_id=form.type_id.data,
+            user_id=current_user.id
+        )
+        db.session.add(new_category)
+        current_user.touch()
+        db.session.commit()
+        
+        flash('Category successfully created', category='success')
+        return redirect(url_for('wallets.dashboard'))
+
+    return render_template('create_category.html', form=form)
+
+
+@bp.route('/categories')
+@login_required
+@read_only
+@conditional
+def categories_list():
+    categories = current_user.get_all_categories()
+    return render_template('categories_list.html', categories=categories)
+
+@bp.route('/category/edit/<int:id>', methods=['GET', 'POST'])
+@login_required
+def edit_category(id):
+    category = owned(Category, id)
+    if not category:
+        flash('Wrong category', category='danger')
+        return redirect(url_for('categories.categories_list'))
+
+    form = CategoryForm(request.form)
+
+    # define choices for operation types
+    form.type_id.choices = types.choices()
+    form.name.data = category.name
+
+    if request.method == 'POST' and form.validate():
+        form = CategoryForm(request.form)
+        category.name = form.name.data
+        category.type_id = form.type_id.data
+        current_user.touch()
+        db.session.commit()
+
+        flash('Category was updated', category='info')
+        return redirect(url_for('categories.categories_list'))
+
+    context = {
+        'form': form,
+        'category': category
+    }
+    return render_template('edit_category.html', **context)
+
+
+@bp.route('/category/delete/<int:id>', methods=['POST'])
+@login_required
+def delete_category(id):
+    category = owned(Category, id)
+    if not category:
+        flash('Wrong category', category='danger')
+        return redirect(url_for('categories.categories_list'))
+
+    db.session.delete(category)
+    current_user.touch()
+    db.session.commit()
+    
+    flash('Category was deleted', category='info')
+    return redirect(url_for('categories.categories_list'))
@@ -0,0 +1,389 @@
+from app import db, uploads
+from models import Wallet, Operation, RecurringOperation, types
+from money import Money
+from forms import OperationForm, ImportForm, OperationFilterForm, SearchForm, RecurringOperationForm
+from views import owned, conditional, read_only, allowed_file, encode_cursor, decode_cursor, OPERATIONS_PER_PAGE
+from importer import import_statement, StatementError
+from search import search_operations
+from uploads import UploadError
+from datetime import datetime, time
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, Response, stream_with_context, current_app
+from flask_login import current_user, login_required
+from sqlalchemy.orm import joinedload
+import csv
+import io
+import json
+
+
+bp = Blueprint('operations', __name__)
+
+
+@bp.route(
+    '/wallet/<int:wallet_id>/operation/create/type/<int:type_id>',
+    methods=['GET', 'POST'])
+@login_required
+def create_operation(wallet_id, type_id):
+    wallet = owned(Wallet, wallet_id)
+    if not wallet:
+        flash('Illegal operation', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+    if types.name(type_id) is None:
+        abort(404)
+
+    form = OperationForm(request.form)
+
+    # all user categories
+    user_categories = current_user.get_all_categories()
+    # Categories with current operation type
+    categories = [x for x in user_categories if x.type_id == type_id]
+    # Make list of tuples with choices for WTForm
+    category_choices = [(cat.id, cat.name) for cat in categories]
+
+    form.type_id.data = type_id
+    form.category.choices = category_choices
+    context = {
+        'form': form,
+        'wallet': wallet,
+    }
+   
+   
+    if request.method == 'POST' and form.validate():
+        filename = None
+        file = request.files.get(form.image.name)
+        if file and allowed_file(file.filename):
+            try:
+                filename = uploads.save(file.stream, file.filename.rsplit('.', 1)[1])
+            except UploadError as e:
+                flash(str(e), category='danger')
+                return render_template('create_operation.html', **context)
+
+        operation = Operation(
+            total=form.total.data,
+            type_id=form.type_id.data,
+            category_id = form.category.data,
+            wallet_id=wallet_id,
+            
+        )
+        operation.filename=filename
+        operation.description=form.description.data
+        
+        db.session.add(operation)
+        current_user.touch()
+        db.session.commit()
+
+        flash('Operation successfully submitted', category='success')
+        return redirect(url_for('wallets.dashboard'))
+
+
+    return render_template('create_operation.html', **context)
+
+
+@bp.route('/wallet/<int:id>/import', methods=['GET', 'POST'])
+@login_required
+def import_operations(id):
+    wallet = owned(Wallet, id)
+    if not wallet:
+        flash('Wrong wallet', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+
+    form = ImportForm(request.form)
+    context = {
+        'form': form,
+        'wallet': wallet,
+    }
+
+    if request.method == 'POST' and form.validate():
+        file = request.files.get(form.statement.name)
+        if not file:
+            flash('Choose a statement file', category='danger')
+            return render_template('import_statement.html', **context)
+
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', errors='replace')
+        try:
+            count = import_statement(current_user.id, wallet.id, stream, form.statement_format.data)
+        except StatementError as e:
+            flash(str(e), category='danger')
+            return render_template('import_statement.html', **context)
+
+        flash(f'{count} operations imported', category='success')
+        return redirect(url_for('wallets.dashboard'))
+
+    return render_template('import_statement.html', **context)
+
+
+@bp.route('/reports')
+@login_required
+@read_only
+@conditional
+def reports():
+    month = request.args.get('month')
+    if month:
+        try:
+            month = datetime.strptime(month, '%Y-%m').date()
+        except ValueError:
+            abort(400)
+
+    context = {
+        'month': month,
+        'monthly': current_user.get_monthly_report(),
+        'categories': current_user.get_category_report(month=month),
+    }
+    return render_template('reports.html', **context)
+
+
+@bp.route('/operations')
+@login_required
+@read_only
+@conditional
+def operations_list():
+    form = OperationFilterForm(request.args)
+
+    wallets = current_user.get_wallets()
+    categories = current_user.get_all_categories()
+    form.wallet.choices = [(0, 'All wallets')] + [(w.id, w.name) for w in wallets]
+    form.category.choices = [(0, 'All categories')] + [(c.id, c.name) for c in categories]
+    form.type_id.choices = [(0, 'All types')] + types.choices()
+
+    filters = {}
+    if form.validate():
+        filters = {
+            'wallet_id': form.wallet.data,
+            'category_id': form.category.data,
+            'type_id': form.type_id.data,
+            'date_from': form.date_from.data and datetime.combine(form.date_from.data, time.min),
+            'date_to': form.date_to.data and datetime.combine(form.date_to.data, time.min),
+        }
+
+    cursor = request.args.get('cursor')
+    page = current_user.get_operations_page(
+        cursor=decode_cursor(cursor) if cursor else None,
+        per_page=OPERATIONS_PER_PAGE,
+        **filters
+    )
+
+    next_url = None
+    if page.next_cursor:
+        args = request.args.to_dict()
+        args['cursor'] = encode_cursor(page.next_cursor)
+        next_url = url_for('operations.operations_list', **args)
+
+    context = {
+        'form': form,
+        'operations': page.operations,
+        'next_url': next_url,
+    }
+    return render_template('operations_list.html', **context)
+
+
+@bp.route('/search')
+@login_required
+def search():
+    form = SearchForm(request.args)
+    if not form.validate():
+        return render_template('search.html', form=form, results=[], next_url=None)
+
+    page = request.args.get('page', 1, type=int)
+    results = search_operations(
+        current_user.id,
+        text=form.q.data,
+        min_total=form.min_total.data,
+        max_total=form.max_total.data,
+        page=max(page, 1),
+        per_page=OPERATIONS_PER_PAGE,
+    )
+
+    next_url = None
+    if len(results) > OPERATIONS_PER_PAGE:
+        results = results[:OPERATIONS_PER_PAGE]
+        args = request.args.to_dict()
+        args['page'] = page + 1
+        next_url = url_for('operations.search', **args)
+
+    context = {
+        'form': form,
+        'results': results,
+        'next_url': next_url,
+    }
+    return render_template('search.html', **context)
+
+
+EXPORT_COLUMNS = ['id', 'created', 'wallet', 'category', 'type', 'total', 'description']
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    # Header goes out before the first row is fetched
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow(row)
+        # Flush every few KB instead of every row
+        if buffer.tell() > 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+}
+
+@bp.route('/operations/export.<fmt>')
+@login_required
+@read_only
+def export_operations(fmt):
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    export, mimetype = EXPORT_FORMATS[fmt]
+
+    rows = current_user.iter_operation_rows()
+    headers = {'Content-Disposition': f'attachment; filename=operations.{fmt}'}
+    return Response(stream_with_context(export(rows)), mimetype=mimetype, headers=headers)
+
+
+@bp.route('/user/<int:user_id>/operation/edit/<int:op_id>', methods=['GET', 'POST'])
+@login_required
+def edit_operation(user_id, op_id):
+    operation = owned(Operation, op_id)
+    
+    if current_user.id != user_id or not operation:
+        flash('Wrong operation', category='info')
+        return redirect(url_for('operations.operations_list'))
+
+    
+    form = OperationForm(request.form)
+
+    user_categories = current_user.get_all_categories()
+    # Categories with current operation type
+    categories = [x for x in user_categories if x.type_id == operation.type_id]
+    # Make list of tuples with choices for WTForm
+    category_choices = [(cat.id, cat.name) for cat in categories]
+
+    form.category.choices = category_choices
+    form.total.data = operation.total
+    form.type_id.data = operation.type_id
+
+    if request.method == 'POST' and form.validate():
+        form = OperationForm(request.form)
+        old_delta = operation.balance_delta
+
+        operation.total = Money.of(form.total.data)
+        operation.category_id = form.category.data
+        Wallet.apply_deltas({operation.wallet_id: operation.balance_delta - old_delta})
+        current_user.touch()
+        db.session.commit()
+        return redirect(url_for('operations.operations_list'))
+
+    context = {
+        'form': form,
+        'operation': operation
+    }
+
+    return render_template('edit_operation.html', **context)
+
+
+@bp.route('/user/<int:user_id>/operation/delete/<int:op_id>', methods=['POST'])
+@login_required
+def delete_operation(user_id, op_id):
+    operation = owned(Operation, op_id)
+    
+    if current_user.id != user_id or not operation:
+        flash('Wrong operation', category='info')
+        return redirect(url_for('operations.operations_list'))
+
+    Wallet.apply_deltas({operation.wallet_id: -operation.balance_delta})
+    db.session.delete(operation)
+    current_user.touch()
+    db.session.commit()
+
+    flash('Operation deleted', category='info')
+    return redirect(url_for('operations.operations_list'))
+
+
+@bp.route('/wallet/<int:id>/recurring/create', methods=['GET', 'POST'])
+@login_required
+def create_recurring(id):
+    wallet = owned(Wallet, id)
+    if not wallet:
+        flash('Wrong wallet', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+
+    form = RecurringOperationForm(request.form)
+    categories = current_user.get_all_categories()
+    form.type_id.choices = types.choices()
+    form.category.choices = [(0, 'No category')] + [
+        (c.id, f'{c.name} ({types.name(c.type_id)})') for c in categories
+    ]
+
+    if request.method == 'POST' and form.validate():
+        category = next((c for c in categories if c.id == form.category.data), None)
+        if category is not None and category.type_id != form.type_id.data:
+            form.category.errors.append('Category is of a different type')
+        else:
+            starts = datetime.combine(form.starts.data, time(hour=12))
+            recurring = RecurringOperation(
+                user_id=current_user.id,
+                wallet_id=wallet.id,
+                category_id=category.id if category else None,
+                type_id=form.type_id.data,
+                total=form.total.data,
+                description=form.description.data,
+                period=form.period.data,
+                interval=form.interval.data,
+                starts=starts,
+                ends=form.ends.data and datetime.combine(form.ends.data, time.max),
+            )
+            db.session.add(recurring)
+            db.session.commit()
+
+            # Occurrences already due are created right away
+            RecurringOperation.run_due(
+                batch_size=current_app.config['RECURRING_BATCH_SIZE'],
+                max_catch_up=current_app.config['RECURRING_MAX_CATCH_UP'],
+                user_id=current_user.id,
+            )
+
+            flash('Recurring operation created', category='success')
+            return redirect(url_for('operations.recurring_list'))
+
+    context = {
+        'form': form,
+        'wallet': wallet,
+    }
+    return render_template('create_recurring.html', **context)
+
+
+@bp.route('/recurring')
+@login_required
+def recurring_list():
+    recurring = RecurringOperation.query \
+        .filter(RecurringOperation.user_id == current_user.id) \
+        .options(joinedload(RecurringOperation.wallet), joinedload(RecurringOperation.category)) \
+        .order_by(RecurringOperation.next_run) \
+        .all()
+    return render_template('recurring_list.html', recurring=recurring)
+
+
+@bp.route('/recurring/delete/<int:id>', methods=['POST'])
+@login_required
+def delete_recurring(id):
+    recurring = owned(RecurringOperation, id)
+    if not recurring:
+        flash('Wrong recurring operation', category='danger')
+        return redirect(url_for('operations.recurring_list'))
+
+    # Operations created so far stay
+    db.session.delete(recurring)
+    db.session.commit()
+
+    flash('Recurring operation deleted', category='info')
+    return redirect(url_for('operations.recurring_list'))
@@ -0,0 +1,177 @@
+from app import db
+from models import Wallet, Operation, types
+from forms import WalletForm, EditWalletForm, TransferForm
+from views import owned, conditional, read_only, dashboard_view_model
+from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask.views import MethodView
+from flask_login import current_user, login_required
+from sqlalchemy.orm.exc import StaleDataError
+
+
+bp = Blueprint('wallets', __name__)
+
+
+@bp.route('/dashboard')
+@login_required
+@read_only
+@conditional
+def dashboard():
+    context = dashboard_view_model(current_user)
+    return render_template('dashboard.html', **context)
+
+
+class CreateWallet(MethodView):
+    @login_required
+    def get(self):
+        form = WalletForm()
+        return render_template('create_wallet.html', form=form)
+
+
+    @login_required
+    def post(self):
+        form = WalletForm(request.form)
+        if form.validate():
+            new_wallet = Wallet(
+                name=form.name.data,
+                pay_type=form.pay_type.data,
+                balance=form.balance.data,
+                user_id=current_user.id
+            )
+            db.session.add(new_wallet)
+            current_user.touch()
+            db.session.commit()
+            flash('New wallet created', category='success')
+            return redirect(url_for('wallets.dashboard'))
+        
+        return render_template('create_wallet.html', form=form)
+
+bp.add_url_rule('/wallet/create', view_func=CreateWallet.as_view('create_wallet'))
+
+
+class EditWallet(MethodView):
+    @login_required
+    def get(self, id):
+        wallet = owned(Wallet, id)
+        if wallet:
+            form = EditWalletForm(
+                name=wallet.name,
+                pay_type=wallet.pay_type,
+                balance=wallet.balance,
+                version=wallet.version
+            )
+            context = {
+                'wallet': wallet,
+                'form': form,
+            }
+            return render_template('edit_wallet.html', **context)
+        
+        flash('Wrong wallet', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+
+
+    @login_required
+    def post(self, id):
+        wallet = owned(Wallet, id)
+        if wallet:
+            form = EditWalletForm(request.form)
+            if form.validate():
+                # Someone changed the balance since the form was rendered
+                if form.version.data != str(wallet.version):
+                    flash('Wallet was changed in the meantime, check the balance and submit again', category='warning')
+                    return redirect(url_for('wallets.edit_wallet', id=id))
+
+                wallet.name=form.name.data
+                wallet.pay_type=form.pay_type.data
+                wallet.balance=form.balance.data
+
+                try:
+                    current_user.touch()
+                    db.session.commit()
+                except StaleDataError:
+                    db.session.rollback()
+                    flash('Wallet was changed in the meantime, check the balance and submit again', category='warning')
+                    return redirect(url_for('wallets.edit_wallet', id=id))
+
+                flash('Wallet updated', category='success')
+                return redirect(url_for('wallets.dashboard'))
+            
+            context = {
+                'wallet': wallet,
+                'form': form,
+            }
+
+            return render_template('edit_wallet.html', **context)
+
+        flash('Wrong wallet', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+
+    
+bp.add_url_rule('/wallet/edit/<int:id>', view_func=EditWallet.as_view('edit_wallet'))
+
+
+@bp.route('/wallet/delete/<int:id>', methods=['POST'])
+@login_required
+def delete_wallet(id):
+    wallet = owned(Wallet, id)
+    if not wallet:
+        flash('Wrong wallet', category='danger')
+        return redirect(url_for('wallets.dashboard'))
+
+    db.session.delete(wallet)
+    current_user.touch()
+    db.session.commit()
+    
+    flash('Wallet deleted', category='info')
+    return redirect(url_for('wallets.dashboard'))
+
+
+@bp.route('/wallet/<int:id>/transfer/create', methods=['GET', 'POST'])
+@login_required
+def create_transfer(id):
+    wallet = owned(Wallet, id)
+    if not wallet:
+        flash('Wrong wallet', category='info')
+        return redirect(url_for('wallets.dashboard'))
+
+    form = TransferForm(request.form)
+
+    all_wallets = current_user.get_wallets()
+    choice_wallets = list(filter((lambda w: w != wallet), all_wallets))
+    
+    form.wallet.choices = [(w.id, w.name) for w in choice_wallets]
+
+    if request.method == 'POST' and form.validate():
+        expense_id, income_id = types.id('expense'), types.id('income')
+        out_transfer = Operation(
+            total = form.total.data,
+            type_id = expense_id,
+            wallet_id = wallet.id,
+            category_id = types.transfer_category(current_user.id, expense_id),
+            change_balance=False
+        )
+        in_transfer = Operation(
+            total = form.total.data,
+            type_id = income_id,
+            wallet_id = form.wallet.data,
+            category_id = types.transfer_category(current_user.id, income_id),
+            change_balance=False
+        )
+        
+        # Both legs and both balance updates commit in one transaction
+        db.session.add_all([out_transfer, in_transfer])
+        Wallet.apply_deltas({
+            out_transfer.wallet_id: out_transfer.balance_delta,
+            in_transfer.wallet_id: in_transfer.balance_delta,
+        }, reason='transfer')
+        current_user.touch()
+        db.session.commit()
+
+        flash('Transfer created', category='success')
+        return redirect(url_for('wallets.dashboard'))
+
+    context = {
+        'wallet': wallet,
+        'form': form
+    }
+    return render_template('create_transfer.html', **context)
+    
@@ -0,0 +1,12 @@
+"""WSGI entry point.
+
+    gunicorn --preload --workers 4 --config gunicorn.conf.py wsgi:app
+
+With --preload the app is built once in the master and the workers are
+forked from it, sharing the imported code copy-on-write. Each worker
+serves requests on a few threads (see gunicorn.conf.py).
+"""
+from app import create_app
+
+
+app = create_app(cli=False)